@@ -1,20 +1,31 @@
+import asyncio
+import functools
 import logging
 import os
 import re
-import signal
-import sys
-from datetime import datetime
+import threading
+import time
+from collections import namedtuple
+from io import BytesIO
+from datetime import datetime, timezone
+
+UTC = timezone.utc
 
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import smtplib
 import ssl
-from sqlalchemy.orm import joinedload
+from sqlalchemy import bindparam, case, func, select
+from sqlalchemy import update as sql_update
+from sqlalchemy.orm import joinedload, selectinload
 
+from aiolimiter import AsyncLimiter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from dotenv import load_dotenv
 from sqlalchemy.exc import IntegrityError
 
+from telegram.error import RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
@@ -22,6 +33,7 @@ from telegram import (
     InlineKeyboardMarkup
 )
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
@@ -68,10 +80,165 @@ if not TELEGRAM_TOKEN:
 if DEVELOPER_CHAT_ID == 0:
     raise ValueError("DEVELOPER_CHAT_ID not set correctly. Please set it to the developer's Telegram chat ID.")
 
+# Admin access is checked by set membership so additional admins can be
+# granted via ADMIN_CHAT_IDS (comma-separated) without new comparisons.
+# DEVELOPER_CHAT_ID stays the target for notifications and /sendmsg.
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_CHAT_IDS", str(DEVELOPER_CHAT_ID)).split(","))
+
 CONSULTATION_PRICE_EUR = 9.00
-EMAIL_REGEX = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+# Shared message bodies, defined once instead of inlined per handler.
+PRICING_MSG = (
+    "👨‍⚕ **پزشک عمومی**\n"
+    "- 📞 *مشاوره تلفنی:* ۹٫۸۹€\n"
+    "- 🏠 *ویزیت حضوری در منزل تورین:* ۲۹€\n\n"
+    "🧴 **پزشک متخصص**\n"
+    "- 📞 *مشاوره تلفنی:* ۱۴٫۵€\n"
+    "- 🏠 *ویزیت حضوری در منزل:* در حال حاضر فقط تلفنی امکان‌پذیر است.\n\n"
+    "🧠 **مشاوره روانشناسی**\n"
+    "- 🕒 *جلسه ۴۵ دقیقه‌ای:* ۸٫۹۹€\n"
+    "- 📦 *پک چند جلسه‌ای:* از طریق پشتیبانی در دسترس است.\n\n"
+    "📝 **مشکل خود را توضیح دهید:**"
+)
+
+WELCOME_BENEFITS = (
+    "👍 **مزایای استفاده از پلتفرم دکتر لاین:**\n\n"
+    "• 🕒 *مشاوره پزشکی ۲۴ ساعته در دسترس*\n"
+    "• 📄 *دریافت نسخه پزشکی معتبر در اروپا*\n"
+    "• 🚫💼 *عدم نیاز به بیمه برای بهره‌مندی از خدمات*\n"
+    "• 🚗🏥 *درخواست ویزیت پزشکی عمومی و تخصصی در منزل بدون انتظار در صف طولانی اورژانس یا نوبت پزشک*\n"
+    "• 📝 *امکان درخواست گواهی‌های:* \n"
+    "  • Certificato di malattia 🤒\n"
+    "  • Certificato dello sport 🏅\n"
+    "  • Certificato medico per Patente 🚗📝\n"
+    "• 🧘‍♀️ *دسترسی به مشاوره روانشناسی*\n\n"
+    "❤️ *علیرغم همکاری با پزشکان فارسی‌زبان مقیم اروپا، دکترلاین سعی دارد تعرفه‌های اقتصادی 💰 را برای تسهیل دسترسی برابر هر قشری به حق سلامت ارائه دهد.*\n\n"
+)
+
+WELCOME_NEW_MSG = (
+    "👋 *به Doctor Line خوش آمدید!*\n\n"
+    + WELCOME_BENEFITS
+    + "✨ همین حالا وقت خود را دریافت کنید  📲\n"
+)
+# Anchored, ASCII-mode and restricted to explicit RFC 5321 character
+# classes: no catastrophic backtracking on adversarial input, no Unicode
+# property checks per char, and look-alike Unicode local parts are rejected
+# rather than silently accepted.
+EMAIL_REGEX = re.compile(r"\A[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\Z", re.ASCII)
+
+# "<user id> <message>" for the developer broadcast command; one scan
+# validates and splits in a single pass.
+SEND_MSG_REGEX = re.compile(r"\A(-?\d+)\s+(.+)\Z", re.S)
+_ALLOWED_RECEIPT_MIME_TYPES = frozenset({"image/jpeg", "image/png"})
+_ALLOWED_RECEIPT_EXTS = frozenset({".jpg", ".jpeg", ".png"})
 RECEIPTS_DIR = "receipts"
-os.makedirs(RECEIPTS_DIR, exist_ok=True)
+# Receipts are relayed to the developer straight from memory; set
+# ARCHIVE_RECEIPTS=1 to additionally keep a copy on disk under RECEIPTS_DIR.
+ARCHIVE_RECEIPTS = os.getenv("ARCHIVE_RECEIPTS", "").lower() in ("1", "true", "yes")
+if ARCHIVE_RECEIPTS:
+    os.makedirs(RECEIPTS_DIR, exist_ok=True)
+
+# Shared status→icon mapping for history listings; built once instead of
+# per appointment row.
+# Email bodies are fixed Persian templates with a handful of variables, so
+# build each one once at import and fill it with format_map per send instead
+# of re-interpolating the whole text in every handler.
+APPT_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "از انتخاب *Doctor Line* برای تنظیم وقت ملاقات متشکریم. جزئیات ملاقات شما به شرح زیر است:\n\n"
+    "• *شناسه ملاقات:* {appt_id}\n"
+    "• *پزشک:* {doctor_name}\n"
+    "• *تخصص:* {appointment_type}\n"
+    "• *روش ارتباط:* {contact_method}\n"
+    "• *توضیح:* {description}\n\n"
+    "*وضعیت:* در انتظار تأیید\n\n"
+    "پس از تأیید، به شما اطلاع خواهیم داد.\n\n"
+    "📅 *تاریخ ملاقات:* {created_at}\n\n"
+    "از انتخاب *Doctor Line* متشکریم. مشتاقانه منتظر کمک به شما هستیم!\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+CERT_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "از درخواست *گواهی سلامت* در *Doctor Line* متشکریم. جزئیات درخواست شما به شرح زیر است:\n\n"
+    "• *شناسه گواهی:* {cert_id}\n"
+    "• *دلیل:* {reason}\n"
+    "• *توضیح:* {description}\n\n"
+    "*وضعیت:* در انتظار تأیید\n\n"
+    "پس از پردازش، به شما اطلاع خواهیم داد.\n\n"
+    "از انتخاب *Doctor Line* متشکریم. در حمایت از نیازهای سلامت و حرفه‌ای شما هستیم!\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+WELCOME_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "به *Doctor Line* خوش آمدید! بسیار خوشحالیم که شما را در جمع خود داریم.\n\n"
+    "جزئیات ثبت‌نام شما به شرح زیر است:\n\n"
+    "• *نام:* {name}\n"
+    "• *ایمیل:* {email}\n"
+    "• *تلفن/شناسه:* {phone}\n\n"
+    "شما اکنون می‌توانید از امکاناتی مانند تنظیم وقت ملاقات، درخواست گواهی سلامت، و مدیریت پروفایل خود از طریق ربات تلگرام ما استفاده کنید.\n\n"
+    "اگر سوالی دارید یا به کمک نیاز دارید، با ما تماس بگیرید.\n\n"
+    "از انتخاب *Doctor Line* متشکریم. مشتاقانه منتظر خدمت به شما هستیم!\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+APPT_APPROVED_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "خبر خوب! درخواست ملاقات شما (شناسه: {appt_id}) با *دکتر {doctor_name}* تأیید شد.\n\n"
+    "• *تخصص:* {appointment_type}\n"
+    "• *روش ارتباط:* {contact_method}\n\n"
+    "منتظر کمک به شما هستیم.\n\n"
+    "📅 *تاریخ ملاقات:* {created_at}\n\n"
+    "از انتخاب *Doctor Line* متشکریم.\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+APPT_REJECTED_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "با تاسف اعلام می‌کنیم که درخواست ملاقات شما (شناسه: {appt_id}) "
+    "با *دکتر {doctor_name}* رد شده است.\n\n"
+    "اگر فکر می‌کنید این اشتباه است یا می‌خواهید مجدداً تنظیم کنید، لطفاً با ما تماس بگیرید.\n\n"
+    "از درک شما متشکریم.\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+CERT_APPROVED_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "تبریک! درخواست گواهی سلامت شما (شناسه: {cert_id}) تأیید شد.\n\n"
+    "• *دلیل:* {reason}\n"
+    "• *توضیح:* {description}\n\n"
+    "شما اکنون می‌توانید با هرگونه نیازمندی لازم ادامه دهید.\n\n"
+    "از انتخاب *Doctor Line* متشکریم.\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+CERT_REJECTED_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "با تاسف اعلام می‌کنیم که درخواست گواهی سلامت شما (شناسه: {cert_id}) "
+    "رد شده است.\n\n"
+    "اگر فکر می‌کنید این اشتباه است یا می‌خواهید دوباره درخواست دهید، لطفاً با ما تماس بگیرید.\n\n"
+    "از درک شما متشکریم.\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+PROFILE_UPDATED_EMAIL_TMPL = (
+    "سلام {name},\n\n"
+    "پروفایل شما با موفقیت به‌روزرسانی شد. جزئیات به‌روزرسانی شده به شرح زیر است:\n\n"
+    "• *نام:* {name}\n"
+    "• *ایمیل:* {email}\n"
+    "• *تلفن/شناسه:* {phone}\n\n"
+    "اگر این تغییر را ایجاد نکرده‌اید یا نگرانی دارید، لطفاً بلافاصله با ما تماس بگیرید.\n\n"
+    "از انتخاب *Doctor Line* متشکریم. همیشه در خدمت شما هستیم!\n\n"
+    "با احترام,\n*تیم Doctor Line*"
+)
+
+CERT_REASONS = frozenset({"عضویت در باشگاه", "گواهی رانندگی", "سایر"})
+
+STATUS_ICONS = {
+    "confirmed": "✅ *تأیید شده*",
+    "pending": "⏳ *در انتظار*",
+    "rejected": "❌ *رد شده*",
+    "canceled": "🚫 *لغو شده*",
+}
+
+# Precompiled 2.0-style statement for the recurring telegram_id lookup;
+# executing a shared Core construct lets the compiled-SQL cache hit every
+# time instead of recompiling an ad-hoc Query per call.
+_USER_BY_TG = select(User).where(User.telegram_id == bindparam('tid'))
 
 scheduler = AsyncIOScheduler()
 
@@ -113,7 +280,10 @@ scheduler = AsyncIOScheduler()
 # Keyboards
 ##################
 
-def main_menu_keyboard(user_id: int) -> ReplyKeyboardMarkup:
+# These keyboards never change at runtime, so build each variant once at
+# import time instead of reallocating identical Markup objects per reply.
+
+def _build_main_menu_keyboard(is_developer: bool) -> ReplyKeyboardMarkup:
     keyboard = [
         ["📅 گرفتن وقت ملاقات"],
         ["📝 دریافت گواهی سلامت"],
@@ -123,38 +293,79 @@ def main_menu_keyboard(user_id: int) -> ReplyKeyboardMarkup:
         ["✏️ ویرایش پروفایل"],
         ["🔄 راه‌اندازی مجدد"]
     ]
-    if user_id == DEVELOPER_CHAT_ID:
+    if is_developer:
         keyboard.append(["🛠 منوی توسعه‌دهنده"])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
 
 
+_MAIN_MENU_USER_KB = _build_main_menu_keyboard(False)
+_MAIN_MENU_DEV_KB = _build_main_menu_keyboard(True)
+_BACK_CANCEL_KB = ReplyKeyboardMarkup([["🔙 بازگشت", "❌ لغو"]], resize_keyboard=True, one_time_keyboard=False)
+_CANCEL_KB = ReplyKeyboardMarkup([["❌ لغو"]], resize_keyboard=True, one_time_keyboard=False)
+_DEVELOPER_MENU_KB = ReplyKeyboardMarkup([
+    ["🗂 مدیریت تخصص‌ها"],
+    ["➕ افزودن پزشک"],
+    ["➖ حذف پزشک"],
+    ["📊 مشاهده آمار"],
+    ["📨 ارسال پیام به کاربر"],
+    ["🔙 بازگشت"]
+], resize_keyboard=True, one_time_keyboard=False)
+
+
+_CERT_REASON_KB = ReplyKeyboardMarkup(
+    [["عضویت در باشگاه"], ["گواهی رانندگی"], ["سایر"], ["🔙 بازگشت"]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+_EDIT_PROFILE_MENU_KB = ReplyKeyboardMarkup(
+    [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
+    resize_keyboard=True
+)
+_EDIT_PROFILE_MENU_ONCE_KB = ReplyKeyboardMarkup(
+    [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+_YES_NO_KB = ReplyKeyboardMarkup([["بله", "خیر"]], resize_keyboard=True)
+_AVAILABILITY_KB = ReplyKeyboardMarkup(
+    [["حضوری"], ["آنلاین"], ["هر دو"], ["🔙 بازگشت", "❌ لغو"]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
+# choice -> (in_person_available, online_available, label for messages)
+_AVAILABILITY_FLAGS = {
+    "حضوری": (True, False, "حضوری"),
+    "آنلاین": (False, True, "آنلاین"),
+    "هر دو": (True, True, "حضوری و آنلاین"),
+}
+
+
+def certificate_reason_keyboard() -> ReplyKeyboardMarkup:
+    return _CERT_REASON_KB
+
+
+def main_menu_keyboard(user_id: int) -> ReplyKeyboardMarkup:
+    return _MAIN_MENU_DEV_KB if user_id in ADMIN_IDS else _MAIN_MENU_USER_KB
+
+
 def payment_menu_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup([["🔙 بازگشت", "❌ لغو"]], resize_keyboard=True, one_time_keyboard=False)
+    return _BACK_CANCEL_KB
 
 
 def cancel_menu_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup([["❌ لغو"]], resize_keyboard=True, one_time_keyboard=False)
+    return _CANCEL_KB
 
 
 def back_cancel_menu_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup([["🔙 بازگشت", "❌ لغو"]], resize_keyboard=True, one_time_keyboard=False)
+    return _BACK_CANCEL_KB
 
 
 def developer_menu_keyboard() -> ReplyKeyboardMarkup:
-    keyboard = [
-        ["🗂 مدیریت تخصص‌ها"],
-        ["➕ افزودن پزشک"],
-        ["➖ حذف پزشک"],
-        ["📊 مشاهده آمار"],
-        ["📨 ارسال پیام به کاربر"],
-        ["🔙 بازگشت"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    return _DEVELOPER_MENU_KB
 
 
-def contact_method_keyboard(available_methods=None):
-    if available_methods is None:
-        available_methods = ["حضوری", "آنلاین", "هر دو"]
+@functools.lru_cache(maxsize=8)
+def _contact_method_kb(available_methods: tuple) -> ReplyKeyboardMarkup:
     buttons = []
     if "حضوری" in available_methods:
         buttons.append("حضوری")
@@ -166,48 +377,188 @@ def contact_method_keyboard(available_methods=None):
     return ReplyKeyboardMarkup([[btn] for btn in buttons], resize_keyboard=True, one_time_keyboard=False)
 
 
+def contact_method_keyboard(available_methods=None):
+    if available_methods is None:
+        available_methods = ("حضوری", "آنلاین", "هر دو")
+    return _contact_method_kb(tuple(available_methods))
+
+
 def specialization_keyboard(include_back=True):
+    # The built markup is cached beside the spec list and dropped together
+    # with it, so repeated menu renders reuse one object.
+    cached = _SPEC_CACHE["keyboards"].get(include_back)
+    if cached is not None and time.monotonic() < _SPEC_CACHE["expires"]:
+        return cached
     specs = get_specializations()
     if not specs:
-        return ReplyKeyboardMarkup([["🔙 بازگشت"]], resize_keyboard=True, one_time_keyboard=False)
-    keyboard = [[s] for s in specs]
-    if include_back:
-        keyboard.append(["🔙 بازگشت"])
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+        markup = ReplyKeyboardMarkup([["🔙 بازگشت"]], resize_keyboard=True, one_time_keyboard=False)
+    else:
+        keyboard = [[s] for s in specs]
+        if include_back:
+            keyboard.append(["🔙 بازگشت"])
+        markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    _SPEC_CACHE["keyboards"][include_back] = markup
+    return markup
 
 
 ##################
 # Helper Functions
 ##################
 
+# Specializations change only when the developer edits them, so cache the
+# list in-process instead of querying on every menu render.
+SPEC_CACHE_TTL = 300  # seconds
+_SPEC_CACHE = {"value": None, "ids": {}, "expires": 0.0, "keyboards": {}}
+
+
+def invalidate_specializations():
+    """Drops the cached specialization list after a developer add/remove."""
+    _SPEC_CACHE["value"] = None
+    _SPEC_CACHE["ids"] = {}
+    _SPEC_CACHE["expires"] = 0.0
+    _SPEC_CACHE["keyboards"] = {}
+
+
 def get_specializations():
+    if _SPEC_CACHE["value"] is not None and time.monotonic() < _SPEC_CACHE["expires"]:
+        return _SPEC_CACHE["value"]
     with Session() as session:
-        specs = session.query(Specialization).all()
-        return [s.name for s in specs]
+        rows = session.query(Specialization.id, Specialization.name).all()
+    _SPEC_CACHE["value"] = [row[1] for row in rows]
+    _SPEC_CACHE["ids"] = {row[1]: row[0] for row in rows}
+    # Keyboards are derived from the list, so they must be rebuilt on every
+    # (re)load — the refreshed expiry would otherwise keep validating stale
+    # markups forever.
+    _SPEC_CACHE["keyboards"] = {}
+    _SPEC_CACHE["expires"] = time.monotonic() + SPEC_CACHE_TTL
+    return _SPEC_CACHE["value"]
+
+
+def get_specialization_id(name):
+    """Resolves a specialization name to its PK from the cached map, or
+    None for unknown names — no SELECT per button press."""
+    if _SPEC_CACHE["value"] is None or time.monotonic() >= _SPEC_CACHE["expires"]:
+        get_specializations()
+    return _SPEC_CACHE["ids"].get(name)
+
+
+# Hot handlers only need a read-only snapshot of the sender's row, so keep
+# a small telegram_id -> CachedUser cache instead of re-querying the users
+# table on every button press. Index 0/1 stay (id, name) for tuple callers.
+USER_CACHE_TTL = 600  # seconds
+USER_CACHE: dict = {}
+
+CachedUser = namedtuple("CachedUser", ["id", "name", "email", "phone", "telegram_id"])
+
+
+def invalidate_user_cache(telegram_id: int):
+    """Drops the cached row after registration or a profile edit."""
+    USER_CACHE.pop(telegram_id, None)
+
+
+def get_cached_user(telegram_id: int):
+    """Returns a detached CachedUser snapshot, or None if unregistered."""
+    entry = USER_CACHE.get(telegram_id)
+    if entry and time.monotonic() < entry[0]:
+        return entry[1]
+    with Session() as session:
+        row = session.query(User.id, User.name, User.email, User.phone).filter_by(
+            telegram_id=telegram_id).first()
+    if row is None:
+        # Don't cache misses, so a fresh registration is visible immediately.
+        return None
+    value = CachedUser(row[0], row[1], row[2], row[3], telegram_id)
+    USER_CACHE[telegram_id] = (time.monotonic() + USER_CACHE_TTL, value)
+    return value
+
+
+async def get_user_by_telegram_id(telegram_id: int):
+    """Async wrapper around get_cached_user; the occasional cache miss runs
+    its SELECT on a worker thread instead of the event loop."""
+    return await run_db(get_cached_user, telegram_id)
 
 
 def get_doctors_by_specialization(spec_name):
+    """Returns lightweight (id, name, in_person_available, online_available)
+    rows — the callers never need full Doctor instances."""
     with Session() as session:
-        spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if not spec:
-            return []
-        return session.query(Doctor).filter_by(specialization_id=spec.id).all()
+        return session.query(
+            Doctor.id, Doctor.name, Doctor.in_person_available, Doctor.online_available
+        ).join(Specialization).filter(Specialization.name == spec_name).all()
 
 
-def format_doctor_availability(doctor: Doctor) -> str:
+def format_availability(in_person: bool, online: bool) -> str:
     availability = []
-    if doctor.in_person_available:
+    if in_person:
         availability.append("حضوری")
-    if doctor.online_available:
+    if online:
         availability.append("آنلاین")
     return " & ".join(availability) if availability else "در دسترس نیست"
 
 
-def send_email(to_email: str, subject: str, body: str):
-    if not EMAIL_REGEX.match(to_email):
-        logger.error(f"ایمیل نامعتبر: {to_email}")
-        return
+def format_doctor_availability(doctor: Doctor) -> str:
+    return format_availability(doctor.in_person_available, doctor.online_available)
+
+
+def doctor_button_label(name: str, in_person: bool, online: bool) -> str:
+    return f"{name} ({format_availability(in_person, online)})"
+
+
+def doctor_list_keyboard(doctors_cache) -> ReplyKeyboardMarkup:
+    keyboard = [[doctor_button_label(name, in_person, online)]
+                for _doc_id, name, in_person, online in doctors_cache]
+    keyboard.append(["🔙 بازگشت"])
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+def cached_doctors(context: ContextTypes.DEFAULT_TYPE):
+    """Doctor tuples for the chosen specialization, kept in user_data so
+    back-navigation and validation don't re-query the database."""
+    cache = context.user_data.get('doctors_cache')
+    if cache is None:
+        spec_name = context.user_data.get('appointment_specialization', "")
+        cache = [(d.id, d.name, d.in_person_available, d.online_available)
+                 for d in get_doctors_by_specialization(spec_name)]
+        context.user_data['doctors_cache'] = cache
+    return cache
+
+
+# One long-lived SMTP connection shared by all sends: each reconnect costs a
+# full TCP + STARTTLS + AUTH exchange, so keep the session open and only
+# rebuild it when the server has dropped it. Guarded by a lock because sends
+# run on worker threads.
+_smtp_client = None
+_smtp_lock = threading.Lock()
+_smtp_sent = 0
+# Providers cap messages per SMTP session; recycle the connection before
+# hitting that limit rather than after a mid-send rejection.
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100
+
+
+def _smtp_connect() -> smtplib.SMTP:
     context_ssl = ssl.create_default_context()
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context_ssl)
+    else:
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+        server.ehlo()
+        server.starttls(context=context_ssl)
+        server.ehlo()
+    server.login(SMTP_USER, SMTP_PASSWORD)
+    return server
+
+
+def _send_email_sync(to_email: str, subject: str, body: str) -> bool:
+    """Delivers one email over the pooled SMTP connection.
+
+    Returns True on success or for permanently invalid addresses (which a
+    retry cannot fix), False on transient delivery failures."""
+    global _smtp_client, _smtp_sent
+    # Cheap short-circuits before the regex: RFC 5321 length cap and a
+    # single-@ check.
+    if len(to_email) > 254 or to_email.count('@') != 1 or not EMAIL_REGEX.match(to_email):
+        logger.error(f"ایمیل نامعتبر: {to_email}")
+        return True
     message = MIMEMultipart("alternative")
     message["Subject"] = subject
     message["From"] = SMTP_USER
@@ -215,20 +566,225 @@ def send_email(to_email: str, subject: str, body: str):
     part = MIMEText(body, "plain")
     message.attach(part)
     try:
-        if SMTP_PORT == 465:
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context_ssl) as server:
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.send_message(message)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.ehlo()
-                server.starttls(context=context_ssl)
-                server.ehlo()
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.send_message(message)
+        with _smtp_lock:
+            if _smtp_client is not None and _smtp_sent >= SMTP_MAX_MESSAGES_PER_CONNECTION:
+                try:
+                    _smtp_client.quit()
+                except (smtplib.SMTPException, OSError):
+                    pass
+                _smtp_client = None
+            if _smtp_client is not None:
+                try:
+                    _smtp_client.noop()
+                except (smtplib.SMTPException, OSError):
+                    _smtp_client = None
+            if _smtp_client is None:
+                _smtp_client = _smtp_connect()
+                _smtp_sent = 0
+            try:
+                _smtp_client.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                _smtp_client = _smtp_connect()
+                _smtp_sent = 0
+                _smtp_client.send_message(message)
+            _smtp_sent += 1
         logger.info(f"ایمیل به {to_email} ارسال شد.")
+        return True
     except Exception as e:
+        with _smtp_lock:
+            _smtp_client = None
         logger.error(f"خطا در ارسال ایمیل: {e}")
+        return False
+
+
+# Emails are queued and delivered by a small pool of worker tasks, so a
+# stalled SMTP server can never hold up a handler reply.
+EMAIL_QUEUE: asyncio.Queue = asyncio.Queue()
+EMAIL_WORKER_COUNT = 3
+
+
+def queue_email(to_email: str, subject: str, body: str) -> None:
+    """Enqueues an outgoing email; delivery happens in the background."""
+    EMAIL_QUEUE.put_nowait((to_email, subject, body))
+
+
+# Transient SMTP failures are retried with exponential backoff before a
+# message is dropped.
+EMAIL_MAX_RETRIES = 3
+
+
+async def _email_worker() -> None:
+    while True:
+        to_email, subject, body = await EMAIL_QUEUE.get()
+        try:
+            for attempt in range(EMAIL_MAX_RETRIES + 1):
+                if await asyncio.to_thread(_send_email_sync, to_email, subject, body):
+                    break
+                if attempt < EMAIL_MAX_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+            else:
+                logger.error(f"ایمیل به {to_email} پس از {EMAIL_MAX_RETRIES} تلاش مجدد ارسال نشد.")
+        finally:
+            EMAIL_QUEUE.task_done()
+
+
+async def run_db(func, *args):
+    """Runs a blocking database function on a worker thread.
+
+    The ORM session API is synchronous, so heavier queries executed inline
+    in an async handler would stall every other chat. Handlers pass a plain
+    function that opens its own Session and returns detached data."""
+    return await asyncio.to_thread(func, *args)
+
+
+async def send_with_flood_control(method, **kwargs):
+    """Awaits a bot method, honoring Telegram flood-control pushback.
+
+    RetryAfter waits out the advertised delay and TimedOut retries
+    immediately; after two such rounds the final attempt propagates its
+    error to the caller. Keeps 429s under the 30 msg/s bot-wide cap from
+    surfacing as spurious failures."""
+    for _ in range(2):
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            logger.warning(f"محدودیت نرخ تلگرام؛ {e.retry_after} ثانیه صبر می‌کنیم.")
+            await asyncio.sleep(e.retry_after)
+        except TimedOut:
+            logger.warning("پاسخ تلگرام دیر رسید؛ تلاش مجدد.")
+    return await method(**kwargs)
+
+
+# Bot-wide pacing for fan-out notifications: Telegram allows ~30 messages
+# per second across all chats, so bulk cancellations throttle themselves
+# slightly below that instead of tripping flood control.
+TG_LIMITER = AsyncLimiter(28, 1.0)
+
+
+async def _notify_user(bot, chat_id: int, text: str) -> None:
+    """Sends one Markdown message under the bot-wide rate limiter.
+
+    Failures (blocked bot, deleted account, ...) are logged and swallowed
+    so one bad recipient never aborts a whole fan-out."""
+    try:
+        await _rl_send(bot.send_message, chat_id=chat_id, text=text, parse_mode="Markdown")
+    except Exception as e:
+        logger.error(f"خطا در اطلاع‌رسانی به کاربر {chat_id}: {e}")
+
+
+async def broadcast(bot, messages) -> None:
+    """Delivers (chat_id, text) pairs concurrently under TG_LIMITER.
+
+    The limiter keeps the whole batch below Telegram's bot-wide send cap
+    while the sends overlap their network waits, so N messages take about
+    ceil(N / rate) seconds instead of N round-trips. Use this (optionally
+    via application.create_task) for anything that messages many users."""
+    await asyncio.gather(*[
+        _notify_user(bot, chat_id, text) for chat_id, text in messages
+    ])
+
+
+async def _rl_send(method, **kwargs):
+    """Awaits one bot call under the bot-wide rate limiter.
+
+    Used for per-user sends on paths a developer can drive in bursts
+    (sweeping many pending approvals), so they pace themselves below the
+    cap instead of hitting 429 backoff."""
+    async with TG_LIMITER:
+        return await send_with_flood_control(method, **kwargs)
+
+
+async def _gather_sends(what: str, *coros):
+    """Awaits independent Telegram calls concurrently, logging failures.
+
+    Used where a handler must both notify a user and acknowledge the
+    developer: the calls share no state, so issuing them together makes
+    the handler as slow as the slower call instead of the sum."""
+    results = await asyncio.gather(*coros, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"خطا در {what}: {result}")
+    return results
+
+
+# Developer notifications go through a queue so a burst of new requests
+# never stalls the users' own replies on Telegram's bot-wide send limit.
+NOTIFY_QUEUE: asyncio.Queue = asyncio.Queue()
+
+
+def queue_developer_notification(text: str, reply_markup=None) -> None:
+    """Enqueues a Markdown message for the developer chat.
+
+    Delivery happens in the background notifier task; callers return
+    immediately instead of awaiting the send."""
+    NOTIFY_QUEUE.put_nowait({"text": text, "reply_markup": reply_markup})
+
+
+async def _dev_notifier(application) -> None:
+    """Background task: drains queued developer notifications in batches.
+
+    Waits ~500 ms after the first item so a burst coalesces; plain texts are
+    joined (up to 10 per message), while notifications carrying an inline
+    keyboard are sent individually since buttons cannot be merged."""
+    while True:
+        items = [await NOTIFY_QUEUE.get()]
+        await asyncio.sleep(0.5)
+        while not NOTIFY_QUEUE.empty():
+            items.append(NOTIFY_QUEUE.get_nowait())
+
+        texts = []
+        for item in items:
+            if item["reply_markup"] is not None:
+                try:
+                    await send_with_flood_control(
+                        application.bot.send_message,
+                        chat_id=DEVELOPER_CHAT_ID,
+                        text=item["text"],
+                        parse_mode="Markdown",
+                        reply_markup=item["reply_markup"]
+                    )
+                except Exception as e:
+                    logger.error(f"عدم موفقیت در ارسال اعلان به توسعه‌دهنده: {e}")
+            else:
+                texts.append(item["text"])
+
+        while texts:
+            batch, texts = texts[:10], texts[10:]
+            try:
+                await send_with_flood_control(
+                    application.bot.send_message,
+                    chat_id=DEVELOPER_CHAT_ID,
+                    text="\n\n---\n\n".join(batch),
+                    parse_mode="Markdown"
+                )
+            except Exception as e:
+                logger.error(f"عدم موفقیت در ارسال اعلان به توسعه‌دهنده: {e}")
+
+
+async def _start_background_tasks(application) -> None:
+    application.create_task(_dev_notifier(application))
+    for _ in range(EMAIL_WORKER_COUNT):
+        application.create_task(_email_worker())
+    # Started here so the scheduler binds to the running event loop.
+    scheduler.start()
+    logger.info("زمان‌بندی شروع شد.")
+
+
+async def _graceful_shutdown(application) -> None:
+    """Runs after PTB has stopped: releases the scheduler, the SMTP
+    connection, and the DB pool so a restart starts clean."""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    global _smtp_client
+    with _smtp_lock:
+        if _smtp_client is not None:
+            try:
+                _smtp_client.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            _smtp_client = None
+    engine.dispose()
+    logger.info("در حال خاموش‌سازی...")
 
 
 ##################
@@ -237,41 +793,11 @@ def send_email(to_email: str, subject: str, body: str):
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+    user = await get_user_by_telegram_id(user_id)
     if user:
-        welcome_text = (
-            f"👋 *خوش آمدید، {user.name}!*\n\n"
-            "👍 **مزایای استفاده از پلتفرم دکتر لاین:**\n\n"
-            "• 🕒 *مشاوره پزشکی ۲۴ ساعته در دسترس*\n"
-            "• 📄 *دریافت نسخه پزشکی معتبر در اروپا*\n"
-            "• 🚫💼 *عدم نیاز به بیمه برای بهره‌مندی از خدمات*\n"
-            "• 🚗🏥 *درخواست ویزیت پزشکی عمومی و تخصصی در منزل بدون انتظار در صف طولانی اورژانس یا نوبت پزشک*\n"
-            "• 📝 *امکان درخواست گواهی‌های:* \n"
-            "  • Certificato di malattia 🤒\n"
-            "  • Certificato dello sport 🏅\n"
-            "  • Certificato medico per Patente 🚗📝\n"
-            "• 🧘‍♀️ *دسترسی به مشاوره روانشناسی*\n\n"
-            "❤️ *علیرغم همکاری با پزشکان فارسی‌زبان مقیم اروپا، دکترلاین سعی دارد تعرفه‌های اقتصادی 💰 را برای تسهیل دسترسی برابر هر قشری به حق سلامت ارائه دهد.*\n\n"
-
-        )
+        welcome_text = f"👋 *خوش آمدید، {_md_escape(user[1])}!*\n\n" + WELCOME_BENEFITS
     else:
-        welcome_text = (
-            "👋 *به Doctor Line خوش آمدید!*\n\n"
-            "👍 **مزایای استفاده از پلتفرم پزشکلاین:**\n\n"
-            "• 🕒 *مشاوره پزشکی ۲۴ ساعته در دسترس*\n"
-            "• 📄 *دریافت نسخه پزشکی معتبر در اروپا*\n"
-            "• 🚫💼 *عدم نیاز به بیمه برای بهره‌مندی از خدمات*\n"
-            "• 🚗🏥 *درخواست ویزیت پزشکی عمومی و تخصصی در منزل بدون انتظار در صف طولانی اورژانس یا نوبت پزشک*\n"
-            "• 📝 *امکان درخواست گواهی‌های:* \n"
-            "  • Certificato di malattia 🤒\n"
-            "  • Certificato dello sport 🏅\n"
-            "  • Certificato medico per Patente 🚗📝\n"
-            "• 🧘‍♀️ *دسترسی به مشاوره روانشناسی*\n\n"
-            "❤️ *علیرغم همکاری با پزشکان فارسی‌زبان مقیم اروپا، دکترلاین سعی دارد تعرفه‌های اقتصادی 💰 را برای تسهیل دسترسی برابر هر قشری به حق سلامت ارائه دهد.*\n\n"
-            "✨ همین حالا وقت خود را دریافت کنید  📲\n"
-
-        )
+        welcome_text = WELCOME_NEW_MSG
 
     await update.message.reply_text(
         welcome_text,
@@ -285,120 +811,138 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 # Main Menu Handler
 ##################
 
-async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    choice = update.message.text.strip()
-    logger.info(f"کاربر انتخاب کرد (منوی اصلی): {choice}")
-    user_id = update.effective_user.id
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+async def _reply_must_register(update: Update, user_id: int) -> int:
+    await update.message.reply_text(
+        "❌ *ابتدا باید ثبت‌نام کنید.*\nلطفاً وقت ملاقات بگیرید یا درخواست گواهی ارسال کنید.",
+        parse_mode="Markdown",
+        reply_markup=main_menu_keyboard(user_id))
+    return MAIN_MENU
 
-    if choice == "📅 گرفتن وقت ملاقات":
-        specs = get_specializations()
-        if not specs:
-            await update.message.reply_text("❌ *در حال حاضر تخصصی موجود نیست.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-        await update.message.reply_text("*لطفاً یک تخصص را انتخاب کنید:*",
+
+async def _menu_new_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    user_id = update.effective_user.id
+    specs = get_specializations()
+    if not specs:
+        await update.message.reply_text("❌ *در حال حاضر تخصصی موجود نیست.*",
                                         parse_mode="Markdown",
-                                        reply_markup=specialization_keyboard())
-        return APPOINTMENT_CHOOSE_SPECIALIZATION
+                                        reply_markup=main_menu_keyboard(user_id))
+        return MAIN_MENU
+    await update.message.reply_text("*لطفاً یک تخصص را انتخاب کنید:*",
+                                    parse_mode="Markdown",
+                                    reply_markup=specialization_keyboard())
+    return APPOINTMENT_CHOOSE_SPECIALIZATION
+
+
+async def _menu_request_certificate(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    await update.message.reply_text(
+        "*لطفاً دلیل دریافت گواهی سلامت را انتخاب کنید:*",
+        parse_mode="Markdown",
+        reply_markup=certificate_reason_keyboard()
+    )
+    return CERTIFICATE_REASON
 
-    elif choice == "📝 دریافت گواهی سلامت":
-        await update.message.reply_text(
-            "*لطفاً دلیل دریافت گواهی سلامت را انتخاب کنید:*",
-            parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup(
-                [["عضویت در باشگاه"], ["گواهی رانندگی"], ["سایر"], ["🔙 بازگشت"]],
-                resize_keyboard=True,
-                one_time_keyboard=True
-            )
-        )
-        return CERTIFICATE_REASON
 
-    elif choice == "📜 تاریخچه ملاقات‌ها":
+async def _menu_history(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    user_id = update.effective_user.id
+    if not user:
+        return await _reply_must_register(update, user_id)
+    # Single round-trip: join on users.telegram_id instead of fetching
+    # the user row first; selectinload pulls the doctors in one extra
+    # SELECT ... IN (...) with no row multiplication. Run on a worker
+    # thread so a long history doesn't stall the event loop.
+    def _load_history(tid):
         with Session() as session_inner:
-            if not user:
-                await update.message.reply_text(
-                    "❌ *ابتدا باید ثبت‌نام کنید.*\nلطفاً وقت ملاقات بگیرید یا درخواست گواهی ارسال کنید.",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu_keyboard(user_id))
-                return MAIN_MENU
-            # Eagerly load 'doctor' relationship using joinedload
-            apps = session_inner.query(Appointment).options(joinedload(Appointment.doctor)).filter(
-                Appointment.user_id == user.id
+            return session_inner.query(Appointment).join(
+                User, User.id == Appointment.user_id
+            ).options(selectinload(Appointment.doctor)).filter(
+                User.telegram_id == tid
             ).order_by(Appointment.created_at.desc()).all()
-        if not apps:
-            await update.message.reply_text("*📅 شما هیچ وقت ملاقاتی ندارید.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-        else:
-            msg = "*📝 ملاقات‌های شما:*\n\n"
-            for ap in apps:
-                # Map status to icons and readable text
-                status_icon = {
-                    "confirmed": "✅ *تأیید شده*",
-                    "pending": "⏳ *در انتظار*",
-                    "rejected": "❌ *رد شده*",
-                    "canceled": "🚫 *لغو شده*"
-                }.get(ap.status, ap.status.capitalize())
-
-                msg += (
-                    f"• *شناسه ملاقات:* {ap.id}\n"
-                    f"  *پزشک:* {ap.doctor.name} ({format_doctor_availability(ap.doctor)})\n"
-                    f"  *روش ارتباط:* {ap.contact_method}\n"
-                    f"  *وضعیت:* {status_icon}\n"
-                    f"  *تاریخ:* {ap.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-                )
-            await update.message.reply_text(msg, parse_mode="Markdown", reply_markup=main_menu_keyboard(user_id))
-        return MAIN_MENU
 
-    elif choice == "✏️ ویرایش پروفایل":
-        if not user:
-            await update.message.reply_text(
-                "❌ *ابتدا باید ثبت‌نام کنید.*\nلطفاً وقت ملاقات بگیرید یا درخواست گواهی ارسال کنید.",
-                parse_mode="Markdown",
-                reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-        kb = [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]]
-        await update.message.reply_text("*لطفاً جزئیاتی که می‌خواهید ویرایش کنید را انتخاب کنید:*",
+    apps = await run_db(_load_history, user_id)
+    if not apps:
+        await update.message.reply_text("*📅 شما هیچ وقت ملاقاتی ندارید.*",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
-        return EDIT_PROFILE_MENU
+                                        reply_markup=main_menu_keyboard(user_id))
+    else:
+        parts = ["*📝 ملاقات‌های شما:*\n\n"]
+        for ap in apps:
+            status_icon = STATUS_ICONS.get(ap.status, ap.status.capitalize())
+            parts.append(
+                f"• *شناسه ملاقات:* {ap.id}\n"
+                f"  *پزشک:* {ap.doctor.name} ({format_doctor_availability(ap.doctor)})\n"
+                f"  *روش ارتباط:* {ap.contact_method}\n"
+                f"  *وضعیت:* {status_icon}\n"
+                f"  *تاریخ:* {ap.created_at:%Y-%m-%d %H:%M}\n\n"
+            )
+        await update.message.reply_text("".join(parts), parse_mode="Markdown", reply_markup=main_menu_keyboard(user_id))
+    return MAIN_MENU
 
-    elif choice == "💳 ارسال پرداخت":
-        if not user:
-            await update.message.reply_text(
-                "❌ *ابتدا باید ثبت‌نام کنید.*\nلطفاً وقت ملاقات بگیرید یا درخواست گواهی ارسال کنید.",
-                parse_mode="Markdown",
-                reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-        await update.message.reply_text(
-            "*🔢 لطفاً شناسه ملاقات خود را وارد کنید:*",
-            parse_mode="Markdown",
-            reply_markup=payment_menu_keyboard()
-        )
-        return PAYMENT_APPOINTMENT_ID
 
-    elif choice == "✉️ تماس با ما":
-        await update.message.reply_text("*✉️ تماس با ما*\n\nلطفاً پیام خود را در زیر وارد کنید:",
-                                        parse_mode="Markdown",
-                                        reply_markup=back_cancel_menu_keyboard())
-        return SEND_MESSAGE_TO_DEVELOPER
+async def _menu_edit_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    user_id = update.effective_user.id
+    if not user:
+        return await _reply_must_register(update, user_id)
+    await update.message.reply_text("*لطفاً جزئیاتی که می‌خواهید ویرایش کنید را انتخاب کنید:*",
+                                    parse_mode="Markdown",
+                                    reply_markup=_EDIT_PROFILE_MENU_KB)
+    return EDIT_PROFILE_MENU
+
+
+async def _menu_submit_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    user_id = update.effective_user.id
+    if not user:
+        return await _reply_must_register(update, user_id)
+    await update.message.reply_text(
+        "*🔢 لطفاً شناسه ملاقات خود را وارد کنید:*",
+        parse_mode="Markdown",
+        reply_markup=payment_menu_keyboard()
+    )
+    return PAYMENT_APPOINTMENT_ID
+
+
+async def _menu_contact_us(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    await update.message.reply_text("*✉️ تماس با ما*\n\nلطفاً پیام خود را در زیر وارد کنید:",
+                                    parse_mode="Markdown",
+                                    reply_markup=back_cancel_menu_keyboard())
+    return SEND_MESSAGE_TO_DEVELOPER
+
+
+async def _menu_restart(update: Update, context: ContextTypes.DEFAULT_TYPE, user) -> int:
+    return await restart(update, context)
+
 
-    elif choice == "🔄 راه‌اندازی مجدد":
-        return await restart(update, context)
+# O(1) routing for the hottest handler instead of walking an if/elif chain
+# of string comparisons per tap.
+MAIN_MENU_DISPATCH = {
+    "📅 گرفتن وقت ملاقات": _menu_new_appointment,
+    "📝 دریافت گواهی سلامت": _menu_request_certificate,
+    "📜 تاریخچه ملاقات‌ها": _menu_history,
+    "✏️ ویرایش پروفایل": _menu_edit_profile,
+    "💳 ارسال پرداخت": _menu_submit_payment,
+    "✉️ تماس با ما": _menu_contact_us,
+    "🔄 راه‌اندازی مجدد": _menu_restart,
+}
 
-    elif choice == "🛠 منوی توسعه‌دهنده" and user_id == DEVELOPER_CHAT_ID:
+
+async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    choice = update.message.text.strip()
+    logger.info(f"کاربر انتخاب کرد (منوی اصلی): {choice}")
+    user_id = update.effective_user.id
+    user = await get_user_by_telegram_id(user_id)
+
+    handler = MAIN_MENU_DISPATCH.get(choice)
+    if handler is not None:
+        return await handler(update, context, user)
+
+    if choice == "🛠 منوی توسعه‌دهنده" and user_id in ADMIN_IDS:
         await update.message.reply_text("*🛠 منوی توسعه‌دهنده:*", parse_mode="Markdown",
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
 
-    else:
-        await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منو را انتخاب کنید.",
-                                        parse_mode="Markdown",
-                                        reply_markup=main_menu_keyboard(user_id))
-        return MAIN_MENU
+    await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منو را انتخاب کنید.",
+                                    parse_mode="Markdown",
+                                    reply_markup=main_menu_keyboard(user_id))
+    return MAIN_MENU
 
 
 ##################
@@ -407,10 +951,9 @@ async def main_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+    user = await get_user_by_telegram_id(user_id)
     if user:
-        await update.message.reply_text(f"🔄 *ربات راه‌اندازی مجدد شد.*\nخوش آمدید، {user.name}!",
+        await update.message.reply_text(f"🔄 *ربات راه‌اندازی مجدد شد.*\nخوش آمدید، {_md_escape(user[1])}!",
                                         parse_mode="Markdown",
                                         reply_markup=main_menu_keyboard(user_id))
         return MAIN_MENU
@@ -428,11 +971,10 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+    context.user_data.pop('doctors_cache', None)
     await update.message.reply_text("🚫 *عملیات لغو شد.*",
                                     parse_mode="Markdown",
-                                    reply_markup=main_menu_keyboard(user.telegram_id if user else user_id))
+                                    reply_markup=main_menu_keyboard(user_id))
     return MAIN_MENU
 
 
@@ -449,14 +991,12 @@ async def appointment_choose_specialization(update: Update, context: ContextType
                                         reply_markup=main_menu_keyboard(user_id))
         return MAIN_MENU
 
-    # Validate specialization
-    with Session() as session:
-        spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if not spec:
-            await update.message.reply_text("❌ *تخصص نامعتبر.* لطفاً دوباره انتخاب کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=specialization_keyboard())
-            return APPOINTMENT_CHOOSE_SPECIALIZATION
+    # Validate specialization against the cached name->id map.
+    if get_specialization_id(spec_name) is None:
+        await update.message.reply_text("❌ *تخصص نامعتبر.* لطفاً دوباره انتخاب کنید:",
+                                        parse_mode="Markdown",
+                                        reply_markup=specialization_keyboard())
+        return APPOINTMENT_CHOOSE_SPECIALIZATION
 
     context.user_data['appointment_specialization'] = spec_name
     doctors = get_doctors_by_specialization(spec_name)
@@ -466,14 +1006,11 @@ async def appointment_choose_specialization(update: Update, context: ContextType
                                         reply_markup=main_menu_keyboard(user_id))
         return MAIN_MENU
 
-    keyboard = []
-    for doc in doctors:
-        availability = format_doctor_availability(doc)
-        keyboard.append([f"{doc.name} ({availability})"])
-    keyboard.append(["🔙 بازگشت"])
+    doctors_cache = [(d.id, d.name, d.in_person_available, d.online_available) for d in doctors]
+    context.user_data['doctors_cache'] = doctors_cache
     await update.message.reply_text("*لطفاً یک پزشک را انتخاب کنید:*",
                                     parse_mode="Markdown",
-                                    reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
+                                    reply_markup=doctor_list_keyboard(doctors_cache))
     return APPOINTMENT_CHOOSE_DOCTOR
 
 
@@ -486,48 +1023,28 @@ async def appointment_choose_doctor(update: Update, context: ContextTypes.DEFAUL
                                         reply_markup=specialization_keyboard())
         return APPOINTMENT_CHOOSE_SPECIALIZATION
 
-    # Extract doctor name and availability
-    match = re.match(r"(.+?) \((.+)\)", doc_selection)
-    if not match:
+    # Resolve the pressed button against the cached doctor tuples — no regex
+    # parsing of the label and no name-based SQL lookup needed.
+    entry = next((d for d in cached_doctors(context)
+                  if doctor_button_label(d[1], d[2], d[3]) == doc_selection), None)
+    if entry is None:
+        # The doctor keyboard from the previous message is still on screen;
+        # omitting reply_markup keeps it without rebuilding anything.
         await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک پزشک را از لیست انتخاب کنید:",
-                                        parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [[f"{doc.name} ({format_doctor_availability(doc)})"] for doc in
-                                             get_doctors_by_specialization(
-                                                 context.user_data.get('appointment_specialization', ""))] + [
-                                                ["🔙 بازگشت"]],
-                                            resize_keyboard=True
-                                        ))
+                                        parse_mode="Markdown")
         return APPOINTMENT_CHOOSE_DOCTOR
 
-    doc_name, availability = match.groups()
-
-    with Session() as session:
-        spec = session.query(Specialization).filter_by(
-            name=context.user_data.get('appointment_specialization', "")).first()
-        doctor = session.query(Doctor).filter_by(name=doc_name, specialization_id=spec.id).first()
-        if not doctor:
-            await update.message.reply_text("❌ *پزشک پیدا نشد.* لطفاً دوباره انتخاب کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=ReplyKeyboardMarkup(
-                                                [[f"{doc.name} ({format_doctor_availability(doc)})"] for doc in
-                                                 get_doctors_by_specialization(
-                                                     context.user_data.get('appointment_specialization', ""))] + [
-                                                    ["🔙 بازگشت"]],
-                                                resize_keyboard=True
-                                            ))
-            return APPOINTMENT_CHOOSE_DOCTOR
-
-    context.user_data['appointment_doctor_id'] = doctor.id
-    logger.info(f"کاربر {user_id} پزشک با شناسه: {doctor.id} را انتخاب کرد.")
+    doctor_id, _doc_name, in_person, online = entry
+    context.user_data['appointment_doctor_id'] = doctor_id
+    logger.info(f"کاربر {user_id} پزشک با شناسه: {doctor_id} را انتخاب کرد.")
 
     # Determine available contact methods based on doctor's availability
     available_methods = []
-    if doctor.in_person_available and doctor.online_available:
+    if in_person and online:
         available_methods = ["حضوری", "آنلاین", "هر دو"]
-    elif doctor.in_person_available:
+    elif in_person:
         available_methods = ["حضوری"]
-    elif doctor.online_available:
+    elif online:
         available_methods = ["آنلاین"]
     else:
         available_methods = []
@@ -544,19 +1061,7 @@ async def appointment_choose_doctor(update: Update, context: ContextTypes.DEFAUL
         context.user_data['appointment_contact_method'] = selected_method
         logger.info(f"کاربر {user_id} روش ارتباطی را به صورت خودکار تنظیم کرد: {selected_method}")
         await update.message.reply_text(
-            """👨‍⚕ **پزشک عمومی**
-        - 📞 *مشاوره تلفنی:* ۹٫۸۹€
-        - 🏠 *ویزیت حضوری در منزل تورین:* ۲۹€
-
-        🧴 **پزشک متخصص**
-        - 📞 *مشاوره تلفنی:* ۱۴٫۵€
-        - 🏠 *ویزیت حضوری در منزل:* در حال حاضر فقط تلفنی امکان‌پذیر است.
-
-        🧠 **مشاوره روانشناسی**
-        - 🕒 *جلسه ۴۵ دقیقه‌ای:* ۸٫۹۹€
-        - 📦 *پک چند جلسه‌ای:* از طریق پشتیبانی در دسترس است.
-
-        📝 **مشکل خود را توضیح دهید:**""",
+            PRICING_MSG,
             parse_mode="Markdown",
             reply_markup=back_cancel_menu_keyboard()
         )
@@ -575,17 +1080,10 @@ async def appointment_contact_method(update: Update, context: ContextTypes.DEFAU
 
     if method == "🔙 بازگشت":
         logger.info(f"کاربر {user_id} به انتخاب پزشک بازگشت.")
-        spec_name = context.user_data.get('appointment_specialization', "")
-        doctors = get_doctors_by_specialization(spec_name)
-        keyboard = []
-        for doc in doctors:
-            availability = format_doctor_availability(doc)
-            keyboard.append([f"{doc.name} ({availability})"])
-        keyboard.append(["🔙 بازگشت"])
         await update.message.reply_text(
             "*لطفاً یک پزشک را انتخاب کنید:*",
             parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+            reply_markup=doctor_list_keyboard(cached_doctors(context))
         )
         return APPOINTMENT_CHOOSE_DOCTOR
 
@@ -605,19 +1103,7 @@ async def appointment_contact_method(update: Update, context: ContextTypes.DEFAU
     context.user_data['appointment_contact_method'] = method
     logger.info(f"کاربر {user_id} روش ارتباطی را تنظیم کرد: {method}")
     await update.message.reply_text(
-        """👨‍⚕ **پزشک عمومی**
-    - 📞 *مشاوره تلفنی:* ۹٫۸۹€
-    - 🏠 *ویزیت حضوری در منزل تورین:* ۲۹€
-
-    🧴 **پزشک متخصص**
-    - 📞 *مشاوره تلفنی:* ۱۴٫۵€
-    - 🏠 *ویزیت حضوری در منزل:* در حال حاضر فقط تلفنی امکان‌پذیر است.
-
-    🧠 **مشاوره روانشناسی**
-    - 🕒 *جلسه ۴۵ دقیقه‌ای:* ۸٫۹۹€
-    - 📦 *پک چند جلسه‌ای:* از طریق پشتیبانی در دسترس است.
-
-    📝 **مشکل خود را توضیح دهید:**""",
+        PRICING_MSG,
         parse_mode="Markdown",
         reply_markup=back_cancel_menu_keyboard()
     )
@@ -633,32 +1119,24 @@ async def appointment_description(update: Update, context: ContextTypes.DEFAULT_
         logger.info(f"کاربر {user_id} به انتخاب روش ارتباط بازگشت.")
         available_methods = []
         doctor_id = context.user_data.get('appointment_doctor_id')
-        with Session() as session:
-            doctor = session.query(Doctor).filter_by(id=doctor_id).first()
-            if doctor.in_person_available and doctor.online_available:
-                available_methods = ["حضوری", "آنلاین", "هر دو"]
-            elif doctor.in_person_available:
-                available_methods = ["حضوری"]
-            elif doctor.online_available:
-                available_methods = ["آنلاین"]
+        entry = next((d for d in cached_doctors(context) if d[0] == doctor_id), None)
+        if entry is None:
+            with Session() as session:
+                doctor = session.get(Doctor, doctor_id)
+                entry = (doctor.id, doctor.name, doctor.in_person_available, doctor.online_available)
+        _doc_id, _doc_name, in_person, online = entry
+        if in_person and online:
+            available_methods = ["حضوری", "آنلاین", "هر دو"]
+        elif in_person:
+            available_methods = ["حضوری"]
+        elif online:
+            available_methods = ["آنلاین"]
         if len(available_methods) == 1:
             selected_method = available_methods[0]
             context.user_data['appointment_contact_method'] = selected_method
             logger.info(f"کاربر {user_id} روش ارتباطی را به صورت خودکار تنظیم کرد: {selected_method}")
             await update.message.reply_text(
-                """👨‍⚕ **پزشک عمومی**
-            - 📞 *مشاوره تلفنی:* ۹٫۸۹€
-            - 🏠 *ویزیت حضوری در منزل تورین:* ۲۹€
-
-            🧴 **پزشک متخصص**
-            - 📞 *مشاوره تلفنی:* ۱۴٫۵€
-            - 🏠 *ویزیت حضوری در منزل:* در حال حاضر فقط تلفنی امکان‌پذیر است.
-
-            🧠 **مشاوره روانشناسی**
-            - 🕒 *جلسه ۴۵ دقیقه‌ای:* ۸٫۹۹€
-            - 📦 *پک چند جلسه‌ای:* از طریق پشتیبانی در دسترس است.
-
-            📝 **مشکل خود را توضیح دهید:**""",
+                PRICING_MSG,
                 parse_mode="Markdown",
                 reply_markup=back_cancel_menu_keyboard()
             )
@@ -688,21 +1166,22 @@ async def appointment_description(update: Update, context: ContextTypes.DEFAULT_
         'specialization': context.user_data.get('appointment_specialization')
     }
 
+    # Check if user exists (before opening the session the cache miss
+    # doesn't need).
+    user = await get_user_by_telegram_id(user_id)
+    if not user:
+        await update.message.reply_text(
+            "*🔍 به نظر می‌رسد که شما ثبت‌نام نکرده‌اید.* بیایید ابتدا ثبت‌نام کنیم.\n\n*نام کامل خود را وارد کنید:*",
+            parse_mode="Markdown",
+            reply_markup=cancel_menu_keyboard()
+        )
+        context.user_data['pending_action'] = 'make_appointment'
+        return REGISTER_NAME
+
     try:
         with Session() as session:
-            # Check if user exists
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                await update.message.reply_text(
-                    "*🔍 به نظر می‌رسد که شما ثبت‌نام نکرده‌اید.* بیایید ابتدا ثبت‌نام کنیم.\n\n*نام کامل خود را وارد کنید:*",
-                    parse_mode="Markdown",
-                    reply_markup=cancel_menu_keyboard()
-                )
-                context.user_data['pending_action'] = 'make_appointment'
-                return REGISTER_NAME
-
             # Check if doctor exists and is available
-            doctor = session.query(Doctor).get(context.user_data['appointment_details']['doctor_id'])
+            doctor = session.get(Doctor, context.user_data['appointment_details']['doctor_id'])
             if not doctor:
                 logger.error(f"پزشک برای شناسه: {context.user_data['appointment_details']['doctor_id']} پیدا نشد.")
                 await update.message.reply_text(
@@ -720,7 +1199,7 @@ async def appointment_description(update: Update, context: ContextTypes.DEFAULT_
                 contact_method=context.user_data['appointment_details']['contact_method'],
                 description=description,
                 status='pending',
-                created_at=datetime.utcnow()
+                created_at=datetime.now(UTC)
             )
 
             session.add(new_appointment)
@@ -730,61 +1209,45 @@ async def appointment_description(update: Update, context: ContextTypes.DEFAULT_
             # Prepare notification message
             notification_message = (
                 f"📅 *درخواست وقت ملاقات جدید*\n\n"
-                f"*کاربر:* {user.name} (شناسه: {user.telegram_id})\n"
-                f"*پزشک:* {doctor.name} ({format_doctor_availability(doctor)})\n"
-                f"*روش ارتباط:* {new_appointment.contact_method}\n"
-                f"*توضیح:* {new_appointment.description}\n\n"
+                f"*کاربر:* {_md_escape(user.name)} (شناسه: {user.telegram_id})\n"
+                f"*پزشک:* {_md_escape(doctor.name)} ({format_doctor_availability(doctor)})\n"
+                f"*روش ارتباط:* {_md_escape(new_appointment.contact_method)}\n"
+                f"*توضیح:* {_md_escape(new_appointment.description)}\n\n"
                 f"*شناسه ملاقات:* {appointment_id}"
             )
 
-            # Try to notify developer
-            try:
-                await context.bot.send_message(
-                    chat_id=DEVELOPER_CHAT_ID,
-                    text=notification_message,
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ تأیید", callback_data=f"confirm_appt_{appointment_id}"),
-                         InlineKeyboardButton("❌ رد", callback_data=f"reject_appt_{appointment_id}")]
-                    ])
-                )
-                logger.info(f"توسعه‌دهنده در مورد ملاقات {appointment_id} مطلع شد.")
-
-                # Send confirmation email to user
-                email_subject = "📅 درخواست وقت ملاقات دریافت شد"
-                email_body = (
-                    f"سلام {user.name},\n\n"
-                    f"از انتخاب *Doctor Line* برای تنظیم وقت ملاقات متشکریم. جزئیات ملاقات شما به شرح زیر است:\n\n"
-                    f"• *شناسه ملاقات:* {appointment_id}\n"
-                    f"• *پزشک:* {doctor.name}\n"
-                    f"• *تخصص:* {new_appointment.appointment_type}\n"
-                    f"• *روش ارتباط:* {new_appointment.contact_method}\n"
-                    f"• *توضیح:* {new_appointment.description}\n\n"
-                    f"*وضعیت:* در انتظار تأیید\n\n"
-                    f"پس از تأیید، به شما اطلاع خواهیم داد.\n\n"
-                    f"📅 *تاریخ ملاقات:* {new_appointment.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-                    f"از انتخاب *Doctor Line* متشکریم. مشتاقانه منتظر کمک به شما هستیم!\n\n"
-                    f"با احترام,\n*تیم Doctor Line*"
-                )
-                send_email(user.email, email_subject, email_body)
+            # Commit first, then queue the notification: the user's reply is
+            # no longer gated on dev-chat delivery.
+            session.commit()
+            invalidate_statistics()
 
-                # If notification successful, commit the transaction
-                session.commit()
+            queue_developer_notification(
+                notification_message,
+                reply_markup=InlineKeyboardMarkup([
+                    [InlineKeyboardButton("✅ تأیید", callback_data=f"confirm_appt_{appointment_id}"),
+                     InlineKeyboardButton("❌ رد", callback_data=f"reject_appt_{appointment_id}")]
+                ])
+            )
+            logger.info(f"اعلان ملاقات {appointment_id} برای توسعه‌دهنده در صف قرار گرفت.")
 
-                await update.message.reply_text(
-                    "✅ *درخواست وقت ملاقات شما ارسال شد و در انتظار تأیید است.*",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu_keyboard(user_id)
-                )
+            # Send confirmation email to user
+            email_subject = "📅 درخواست وقت ملاقات دریافت شد"
+            email_body = APPT_EMAIL_TMPL.format_map({
+                'name': user.name,
+                'appt_id': appointment_id,
+                'doctor_name': doctor.name,
+                'appointment_type': new_appointment.appointment_type,
+                'contact_method': new_appointment.contact_method,
+                'description': new_appointment.description,
+                'created_at': f"{new_appointment.created_at:%Y-%m-%d %H:%M}",
+            })
+            queue_email(user.email, email_subject, email_body)
 
-            except Exception as e:
-                logger.error(f"عدم موفقیت در اطلاع‌رسانی به توسعه‌دهنده در مورد ملاقات: {e}")
-                session.rollback()
-                await update.message.reply_text(
-                    "❌ *در حال حاضر قادر به پردازش درخواست وقت ملاقات شما نیستیم.* لطفاً بعداً تلاش کنید.",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu_keyboard(user_id)
-                )
+            await update.message.reply_text(
+                "✅ *درخواست وقت ملاقات شما ارسال شد و در انتظار تأیید است.*",
+                parse_mode="Markdown",
+                reply_markup=main_menu_keyboard(user_id)
+            )
 
     except Exception as e:
         logger.error(f"خطا در ایجاد ملاقات: {e}")
@@ -797,6 +1260,7 @@ async def appointment_description(update: Update, context: ContextTypes.DEFAULT_
     # Clear appointment data
     context.user_data.pop('appointment_details', None)
     context.user_data.pop('pending_action', None)
+    context.user_data.pop('doctors_cache', None)
 
     return MAIN_MENU
 
@@ -814,14 +1278,10 @@ async def certificate_reason(update: Update, context: ContextTypes.DEFAULT_TYPE)
                                         reply_markup=main_menu_keyboard(user_id))
         return MAIN_MENU
 
-    if reason not in ["عضویت در باشگاه", "گواهی رانندگی", "سایر"]:
+    if reason not in CERT_REASONS:
         await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً دلیل مناسبی را انتخاب کنید:",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["عضویت در باشگاه"], ["گواهی رانندگی"], ["سایر"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=certificate_reason_keyboard())
         return CERTIFICATE_REASON
 
     context.user_data['certificate_reason'] = reason
@@ -837,6 +1297,82 @@ async def certificate_reason(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
     return CERTIFICATE_DESCRIPTION
 
+async def notify_certificate_request(update, context, user, reason, description, cert_id) -> int:
+    """Sends the post-insert messages for a pending HealthCertificate: the
+    queued developer notification, the confirmation email and the user's
+    reply. `user` only needs name/email/telegram_id attributes."""
+    user_name, user_email = user.name, user.email
+    user_id = user.telegram_id
+
+    dev_text = (
+        f"📜 *درخواست گواهی سلامت جدید*\n\n"
+        f"*کاربر:* {_md_escape(user_name)} (شناسه:{user_id})\n"
+        f"*دلیل:* {_md_escape(reason)}\n"
+        f"*توضیح:* {_md_escape(description)}\n\n"
+        f"*شناسه گواهی:* {cert_id}"
+    )
+    dev_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ تایید", callback_data=f"approve_cert_{cert_id}"),
+         InlineKeyboardButton("❌ رد", callback_data=f"reject_cert_{cert_id}")]
+    ])
+
+    email_subject = "📜 درخواست گواهی سلامت دریافت شد"
+    email_body = CERT_EMAIL_TMPL.format_map({
+        'name': user_name,
+        'cert_id': cert_id,
+        'reason': reason,
+        'description': description,
+    })
+    queue_email(user_email, email_subject, email_body)
+
+    # Hand the developer notification to the background batcher — the
+    # user's confirmation is never gated on dev-chat delivery, and bursts
+    # of requests stay within the bot-wide send budget.
+    queue_developer_notification(dev_text, reply_markup=dev_markup)
+    logger.info(f"اعلان گواهی سلامت {cert_id} برای توسعه‌دهنده در صف قرار گرفت.")
+
+    await update.message.reply_text("*✅ درخواست گواهی سلامت شما در انتظار تأیید است.*",
+                                    parse_mode="Markdown",
+                                    reply_markup=main_menu_keyboard(user_id))
+    return MAIN_MENU
+
+
+async def create_and_notify_certificate(update, context, user, reason, description) -> int:
+    """Creates a pending HealthCertificate and sends every follow-up message.
+
+    Used by certificate_description; the post-registration path inserts the
+    certificate in the same transaction as the user row and then calls
+    notify_certificate_request directly."""
+    user_pk = user.id
+    user_id = user.telegram_id
+
+    def _insert():
+        with Session() as session:
+            certificate = HealthCertificate(
+                user_id=user_pk,
+                reason=reason,
+                description=description,
+                status='pending',
+                created_at=datetime.now(UTC)
+            )
+            session.add(certificate)
+            session.commit()
+            invalidate_statistics()
+            return certificate.id
+
+    try:
+        cert_id = await run_db(_insert)
+        logger.info(f"گواهی سلامت {cert_id} برای کاربر {user_id} ایجاد شد.")
+    except IntegrityError as e:
+        logger.error(f"خطا در ایجاد گواهی سلامت: {e}")
+        await update.message.reply_text("❌ *در پردازش درخواست شما خطایی رخ داد.* لطفاً دوباره تلاش کنید.",
+                                        parse_mode="Markdown",
+                                        reply_markup=main_menu_keyboard(user_id))
+        return MAIN_MENU
+
+    return await notify_certificate_request(update, context, user, reason, description, cert_id)
+
+
 async def certificate_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     description = update.message.text.strip()
 
@@ -845,11 +1381,7 @@ async def certificate_description(update: Update, context: ContextTypes.DEFAULT_
 
     if description == "🔙 بازگشت":
         await update.message.reply_text("*🔙 بازگشت به انتخاب دلیل.*", parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["عضویت در باشگاه"], ["گواهی رانندگی"], ["سایر"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=certificate_reason_keyboard())
         return CERTIFICATE_REASON
 
     if description == "❌ لغو":
@@ -862,89 +1394,28 @@ async def certificate_description(update: Update, context: ContextTypes.DEFAULT_
                                         reply_markup=back_cancel_menu_keyboard())
         return CERTIFICATE_DESCRIPTION
 
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            # Prompt for registration
-            await update.message.reply_text(
-                "*🔍 به نظر می‌رسد که شما ثبت‌نام نکرده‌اید.* بیایید ابتدا ثبت‌نام کنیم.\n\n*نام کامل خود را وارد کنید:*",
-                parse_mode="Markdown",
-                reply_markup=cancel_menu_keyboard()
-            )
-            context.user_data['pending_action'] = 'request_certificate'
-            context.user_data['certificate_details'] = {
-                'reason': context.user_data.get('certificate_reason'),
-                'description': description
-            }
-            return REGISTER_NAME
-
-        # Proceed to create certificate request
-        certificate = HealthCertificate(
-            user_id=user.id,
-            reason=context.user_data.get('certificate_reason'),
-            description=description,
-            status='pending',
-            created_at=datetime.utcnow()
+    user = await get_user_by_telegram_id(user_id)
+    if not user:
+        # Prompt for registration
+        await update.message.reply_text(
+            "*🔍 به نظر می‌رسد که شما ثبت‌نام نکرده‌اید.* بیایید ابتدا ثبت‌نام کنیم.\n\n*نام کامل خود را وارد کنید:*",
+            parse_mode="Markdown",
+            reply_markup=cancel_menu_keyboard()
         )
-        session.add(certificate)
-        try:
-            session.commit()
-            logger.info(f"گواهی سلامت {certificate.id} برای کاربر {user_id} ایجاد شد.")
-        except IntegrityError as e:
-            logger.error(f"خطا در ایجاد گواهی سلامت: {e}")
-            session.rollback()
-            await update.message.reply_text("❌ *در پردازش درخواست شما خطایی رخ داد.* لطفاً دوباره تلاش کنید.",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-
-        # Notify developer
-        try:
-            await context.bot.send_message(
-                chat_id=DEVELOPER_CHAT_ID,
-                text=(
-                    f"📜 *درخواست گواهی سلامت جدید*\n\n"
-                    f"*کاربر:* {user.name} (شناسه:{user.telegram_id})\n"
-                    f"*دلیل:* {certificate.reason}\n"
-                    f"*توضیح:* {certificate.description}\n\n"
-                    f"*شناسه گواهی:* {certificate.id}"
-                ),
-                parse_mode="Markdown",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تایید", callback_data=f"approve_cert_{certificate.id}"),
-                     InlineKeyboardButton("❌ رد", callback_data=f"reject_cert_{certificate.id}")]
-                ])
-            )
-            logger.info(f"توسعه‌دهنده در مورد گواهی سلامت {certificate.id} مطلع شد.")
-        except Exception as e:
-            logger.error(f"خطا در اطلاع‌رسانی به توسعه‌دهنده در مورد گواهی سلامت: {e}")
-            await update.message.reply_text("❌ *ناتوان در اطلاع‌رسانی به توسعه‌دهنده.* لطفاً بعداً دوباره تلاش کنید.",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-
-    # Send confirmation email to user
-    email_subject = "📜 درخواست گواهی سلامت دریافت شد"
-    email_body = (
-        f"سلام {user.name},\n\n"
-        f"از درخواست *گواهی سلامت* در *Doctor Line* متشکریم. جزئیات درخواست شما به شرح زیر است:\n\n"
-        f"• *شناسه گواهی:* {certificate.id}\n"
-        f"• *دلیل:* {certificate.reason}\n"
-        f"• *توضیح:* {certificate.description}\n\n"
-        f"*وضعیت:* در انتظار تأیید\n\n"
-        f"پس از پردازش، به شما اطلاع خواهیم داد.\n\n"
-        f"از انتخاب *Doctor Line* متشکریم. در حمایت از نیازهای سلامت و حرفه‌ای شما هستیم!\n\n"
-        f"با احترام,\n*تیم Doctor Line*"
-    )
-    send_email(user.email, email_subject, email_body)
+        context.user_data['pending_action'] = 'request_certificate'
+        context.user_data['certificate_details'] = {
+            'reason': context.user_data.get('certificate_reason'),
+            'description': description
+        }
+        return REGISTER_NAME
 
-    await update.message.reply_text("*✅ درخواست گواهی سلامت شما در انتظار تأیید است.*",
-                                    parse_mode="Markdown",
-                                    reply_markup=main_menu_keyboard(user_id))
+    result = await create_and_notify_certificate(
+        update, context, user,
+        context.user_data.get('certificate_reason'), description)
     # Clear pending action and details
     context.user_data.pop('pending_action', None)
     context.user_data.pop('certificate_details', None)
-    return MAIN_MENU
+    return result
 
 
 ##################
@@ -1017,150 +1488,98 @@ async def register_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     name = context.user_data.get('reg_name')
     email = context.user_data.get('reg_email')
 
-    with Session() as session:
-        existing_user = session.query(User).filter_by(telegram_id=user_id).first()
-        if existing_user:
-            existing_user.name = name
-            existing_user.email = email
-            existing_user.phone = phone
-            action = "به‌روزرسانی شد"
-            user = existing_user  # **Define 'user' here**
-        else:
-            new_user = User(
-                telegram_id=user_id,
-                name=name,
-                email=email,
-                phone=phone
-            )
-            session.add(new_user)
-            action = "ثبت‌نام شد"
-            user = new_user  # **Define 'user' here**
-
-        try:
-            session.commit()
-            logger.info(f"کاربر {user_id} با موفقیت {action}.")
-            await update.message.reply_text(f"✅ *شما با موفقیت {action}.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-        except IntegrityError as e:
-            logger.error(f"خطا در ثبت‌نام/به‌روزرسانی کاربر {user_id}: {e}")
-            session.rollback()
-            await update.message.reply_text("*❌ ثبت‌نام/به‌روزرسانی ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=main_menu_keyboard(user_id))
-            return MAIN_MENU
-
-        # Send confirmation email to user
-        if action == "ثبت‌نام شد":
-            email_subject = "👋 خوش آمدید به Doctor Line!"
-            email_body = (
-                f"سلام {name},\n\n"
-                f"به *Doctor Line* خوش آمدید! بسیار خوشحالیم که شما را در جمع خود داریم.\n\n"
-                f"جزئیات ثبت‌نام شما به شرح زیر است:\n\n"
-                f"• *نام:* {name}\n"
-                f"• *ایمیل:* {email}\n"
-                f"• *تلفن/شناسه:* {phone}\n\n"
-                f"شما اکنون می‌توانید از امکاناتی مانند تنظیم وقت ملاقات، درخواست گواهی سلامت، و مدیریت پروفایل خود از طریق ربات تلگرام ما استفاده کنید.\n\n"
-                f"اگر سوالی دارید یا به کمک نیاز دارید، با ما تماس بگیرید.\n\n"
-                f"از انتخاب *Doctor Line* متشکریم. مشتاقانه منتظر خدمت به شما هستیم!\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-        else:
-            email_subject = "🔄 پروفایل با موفقیت به‌روزرسانی شد"
-            email_body = (
-                f"سلام {name},\n\n"
-                f"پروفایل شما با موفقیت به‌روزرسانی شد. جزئیات به‌روزرسانی شده به شرح زیر است:\n\n"
-                f"• *نام:* {name}\n"
-                f"• *ایمیل:* {email}\n"
-                f"• *تلفن/شناسه:* {phone}\n\n"
-                f"اگر این تغییر را ایجاد نکرده‌اید یا نگرانی دارید، لطفاً بلافاصله با ما تماس بگیرید.\n\n"
-                f"از انتخاب *Doctor Line* متشکریم. همیشه در خدمت شما هستیم!\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-        send_email(email, email_subject, email_body)
-
-        # Handle pending actions if any
-        pending_action = context.user_data.get('pending_action')
-        if pending_action == 'make_appointment':
-            # Existing appointment handling logic
-            # Ensure 'user' is defined and used correctly here
-            # ...
-            pass  # Replace with actual logic
-        elif pending_action == 'request_certificate':
-            certificate_details = context.user_data.get('certificate_details', {})
-            reason = certificate_details.get('reason')
-            description = certificate_details.get('description')
-
-            if not reason or not description:
-                await update.message.reply_text(
-                    "*❌ اطلاعات گواهی نامکمل است. لطفاً دوباره تلاش کنید.*",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu_keyboard(user_id)
+    # A pending certificate request is written in the same transaction as
+    # the user row: flush populates user.id for the FK and a single commit
+    # covers both, instead of two durable writes for one user action.
+    pending_action = context.user_data.get('pending_action')
+    certificate_details = context.user_data.get('certificate_details', {})
+    pending_cert = None
+    if pending_action == 'request_certificate':
+        if certificate_details.get('reason') and certificate_details.get('description'):
+            pending_cert = (certificate_details['reason'], certificate_details['description'])
+
+    # Keep the session open only for the upsert itself; every Telegram and
+    # SMTP round-trip below runs after the connection is back in the pool.
+    def _upsert():
+        with Session() as session:
+            existing_user = session.execute(_USER_BY_TG, {'tid': user_id}).scalar_one_or_none()
+            if existing_user:
+                existing_user.name = name
+                existing_user.email = email
+                existing_user.phone = phone
+                action = "به‌روزرسانی شد"
+                user = existing_user
+            else:
+                user = User(
+                    telegram_id=user_id,
+                    name=name,
+                    email=email,
+                    phone=phone
                 )
-                return MAIN_MENU
-
-            try:
-                # Create new health certificate
+                session.add(user)
+                action = "ثبت‌نام شد"
+            cert_id = None
+            if pending_cert is not None:
+                session.flush()  # populate user.id without a second commit
                 certificate = HealthCertificate(
-                    user_id=user.id,  # Now 'user' is defined
-                    reason=reason,
-                    description=description,
+                    user_id=user.id,
+                    reason=pending_cert[0],
+                    description=pending_cert[1],
                     status='pending',
-                    created_at=datetime.utcnow()
+                    created_at=datetime.now(UTC)
                 )
                 session.add(certificate)
-                session.commit()
-                logger.info(f"گواهی سلامت {certificate.id} برای کاربر {user_id} ایجاد شد.")
+            session.commit()
+            invalidate_statistics()
+            if pending_cert is not None:
+                cert_id = certificate.id
+            return action, CachedUser(user.id, name, email, phone, user_id), cert_id
 
-                # Notify developer
-                await context.bot.send_message(
-                    chat_id=DEVELOPER_CHAT_ID,
-                    text=(
-                        f"📜 *درخواست گواهی سلامت جدید*\n\n"
-                        f"*کاربر:* {user.name} (شناسه:{user.telegram_id})\n"
-                        f"*دلیل:* {certificate.reason}\n"
-                        f"*توضیح:* {certificate.description}\n\n"
-                        f"*شناسه گواهی:* {certificate.id}"
-                    ),
-                    parse_mode="Markdown",
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ تایید", callback_data=f"approve_cert_{certificate.id}"),
-                         InlineKeyboardButton("❌ رد", callback_data=f"reject_cert_{certificate.id}")]
-                    ])
-                )
-                logger.info(f"توسعه‌دهنده در مورد گواهی سلامت {certificate.id} مطلع شد.")
-
-                # Send confirmation email to user
-                email_subject = "📜 درخواست گواهی سلامت دریافت شد"
-                email_body = (
-                    f"سلام {user.name},\n\n"
-                    f"از درخواست *گواهی سلامت* در *Doctor Line* متشکریم. جزئیات درخواست شما به شرح زیر است:\n\n"
-                    f"• *شناسه گواهی:* {certificate.id}\n"
-                    f"• *دلیل:* {certificate.reason}\n"
-                    f"• *توضیح:* {certificate.description}\n\n"
-                    f"*وضعیت:* در انتظار تأیید\n\n"
-                    f"پس از پردازش، به شما اطلاع خواهیم داد.\n\n"
-                    f"از انتخاب *Doctor Line* متشکریم. در حمایت از نیازهای سلامت و حرفه‌ای شما هستیم!\n\n"
-                    f"با احترام,\n*تیم Doctor Line*"
-                )
-                send_email(user.email, email_subject, email_body)
+    try:
+        action, user, cert_id = await run_db(_upsert)
+    except IntegrityError as e:
+        logger.error(f"خطا در ثبت‌نام/به‌روزرسانی کاربر {user_id}: {e}")
+        await update.message.reply_text("*❌ ثبت‌نام/به‌روزرسانی ناموفق بود. لطفاً دوباره تلاش کنید.*",
+                                        parse_mode="Markdown",
+                                        reply_markup=main_menu_keyboard(user_id))
+        return MAIN_MENU
 
-                await update.message.reply_text("*✅ درخواست گواهی سلامت شما در انتظار تأیید است.*",
-                                                parse_mode="Markdown",
-                                                reply_markup=main_menu_keyboard(user_id))
-            except Exception as e:
-                logger.error(f"خطا در ایجاد گواهی سلامت برای کاربر {user_id}: {e}")
-                await update.message.reply_text(
-                    "*❌ خطایی در پردازش درخواست شما رخ داد.* لطفاً دوباره تلاش کنید.",
-                    parse_mode="Markdown",
-                    reply_markup=main_menu_keyboard(user_id)
-                )
+    invalidate_user_cache(user_id)
+    logger.info(f"کاربر {user_id} با موفقیت {action}.")
+    await update.message.reply_text(f"✅ *شما با موفقیت {action}.*",
+                                    parse_mode="Markdown",
+                                    reply_markup=main_menu_keyboard(user_id))
 
-        # Clear pending action and details
-        context.user_data.pop('pending_action', None)
-        context.user_data.pop('certificate_details', None)
+    # Send confirmation email to user
+    if action == "ثبت‌نام شد":
+        email_subject = "👋 خوش آمدید به Doctor Line!"
+        email_body = WELCOME_EMAIL_TMPL.format_map({'name': name, 'email': email, 'phone': phone})
+    else:
+        email_subject = "🔄 پروفایل با موفقیت به‌روزرسانی شد"
+        email_body = PROFILE_UPDATED_EMAIL_TMPL.format_map({'name': name, 'email': email, 'phone': phone})
+    queue_email(email, email_subject, email_body)
 
-        return MAIN_MENU
+    # Handle pending actions if any
+    if pending_action == 'request_certificate':
+        if pending_cert is None:
+            await update.message.reply_text(
+                "*❌ اطلاعات گواهی نامکمل است. لطفاً دوباره تلاش کنید.*",
+                parse_mode="Markdown",
+                reply_markup=main_menu_keyboard(user_id)
+            )
+            return MAIN_MENU
+
+        logger.info(f"گواهی سلامت {cert_id} برای کاربر {user_id} ایجاد شد.")
+        try:
+            await notify_certificate_request(update, context, user,
+                                             pending_cert[0], pending_cert[1], cert_id)
+        except Exception as e:
+            logger.error(f"خطا در ایجاد گواهی سلامت برای کاربر {user_id}: {e}")
+            await update.message.reply_text(
+                "*❌ خطایی در پردازش درخواست شما رخ داد.* لطفاً دوباره تلاش کنید.",
+                parse_mode="Markdown",
+                reply_markup=main_menu_keyboard(user_id)
+            )
 
     # Clear pending action and details
     context.user_data.pop('pending_action', None)
@@ -1192,9 +1611,10 @@ async def payment_appointment_id_handler(update: Update, context: ContextTypes.D
         return PAYMENT_APPOINTMENT_ID
 
     appointment_id = int(appointment_id_text)
+    user = await get_user_by_telegram_id(user_id)
 
     with Session() as session:
-        appointment = session.query(Appointment).filter_by(id=appointment_id).first()
+        appointment = session.get(Appointment, appointment_id)
         if not appointment:
             await update.message.reply_text("*❌ ملاقات پیدا نشد. لطفاً یک شناسه ملاقات معتبر وارد کنید:*",
                                             parse_mode="Markdown",
@@ -1202,7 +1622,6 @@ async def payment_appointment_id_handler(update: Update, context: ContextTypes.D
             return PAYMENT_APPOINTMENT_ID
 
         # Check if appointment belongs to the user
-        user = session.query(User).filter_by(telegram_id=user_id).first()
         if not user or appointment.user_id != user.id:
             await update.message.reply_text("*❌ شما اجازه ارسال رسید برای این ملاقات را ندارید.*",
                                             parse_mode="Markdown",
@@ -1226,14 +1645,23 @@ async def payment_appointment_id_handler(update: Update, context: ContextTypes.D
         return PAYMENT_RECEIPT
 
 
+def _write_receipt_archive(file_path: str, data: bytes) -> None:
+    """Best-effort on-disk copy of a relayed receipt (ARCHIVE_RECEIPTS=1)."""
+    try:
+        with open(file_path, 'wb') as archive_file:
+            archive_file.write(data)
+        logger.info(f"نسخه آرشیو رسید ذخیره شد: {file_path}")
+    except OSError as e:
+        logger.warning(f"ناتوان در ذخیره آرشیو رسید: {file_path}. خطا: {e}")
+
+
 async def payment_receipt_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.debug("وارد شدن به payment_receipt_handler")
     user_id = update.effective_user.id
     appointment_id = context.user_data.get('payment_appointment_id')
     logger.debug(f"پردازش رسید پرداخت برای شناسه ملاقات: {appointment_id}, شناسه کاربر: {user_id}")
 
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+    user = await get_user_by_telegram_id(user_id)
 
     if not user:
         logger.warning(f"کاربر {user_id} تلاش کرد رسید پرداخت ارسال کند بدون ثبت‌نام.")
@@ -1253,19 +1681,22 @@ async def payment_receipt_handler(update: Update, context: ContextTypes.DEFAULT_
         return MAIN_MENU
 
     # Initialize variables
-    file_path = None
+    receipt_buf = None
+    file_name = None
     caption = ""
 
     if update.message.photo:
         photo = update.message.photo[-1]
         file = await photo.get_file()
-        timestamp = int(datetime.utcnow().timestamp())
-        file_path = os.path.join(RECEIPTS_DIR, f"receipt_{user_id}_{timestamp}.jpg")
+        timestamp = time.time_ns()
+        file_name = f"receipt_{user_id}_{timestamp}.jpg"
         try:
-            await file.download_to_drive(file_path)
-            logger.info(f"رسید پرداخت به {file_path} دانلود شد.")
+            receipt_buf = BytesIO()
+            await file.download_to_memory(receipt_buf)
+            receipt_buf.seek(0)
+            logger.info(f"رسید پرداخت از کاربر {user_id} در حافظه دریافت شد.")
             caption = (
-                f"📷 *رسید پرداخت از {user.name} (شناسه: {user.telegram_id})*\n"
+                f"📷 *رسید پرداخت از {_md_escape(user.name)} (شناسه: {user.telegram_id})*\n"
                 f"*شناسه ملاقات:* {appointment_id}\n\n"
                 f"لطفاً پرداخت را تأیید کنید."
             )
@@ -1278,20 +1709,26 @@ async def payment_receipt_handler(update: Update, context: ContextTypes.DEFAULT_
 
     elif update.message.document:
         document = update.message.document
-        file = await document.get_file()
-        timestamp = int(datetime.utcnow().timestamp())
-        file_extension = os.path.splitext(document.file_name)[1].lower()
-        if file_extension not in ['.jpg', '.jpeg', '.png']:
+        # Validate before fetching the file: the mime type Telegram already
+        # supplied is free to check, and the extension allow-list is a set
+        # lookup on an rpartition suffix instead of splitext + list scan.
+        file_extension = "." + document.file_name.rpartition(".")[2].lower()
+        if (document.mime_type and document.mime_type not in _ALLOWED_RECEIPT_MIME_TYPES) \
+                or file_extension not in _ALLOWED_RECEIPT_EXTS:
             await update.message.reply_text("*❌ نوع فایل پشتیبانی‌شده نیست. لطفاً یک تصویر JPG یا PNG ارسال کنید.*",
                                             parse_mode="Markdown",
                                             reply_markup=payment_menu_keyboard())
             return PAYMENT_RECEIPT
-        file_path = os.path.join(RECEIPTS_DIR, f"receipt_{user_id}_{timestamp}{file_extension}")
+        file = await document.get_file()
+        timestamp = time.time_ns()
+        file_name = f"receipt_{user_id}_{timestamp}{file_extension}"
         try:
-            await file.download_to_drive(file_path)
-            logger.info(f"رسید پرداخت به {file_path} دانلود شد.")
+            receipt_buf = BytesIO()
+            await file.download_to_memory(receipt_buf)
+            receipt_buf.seek(0)
+            logger.info(f"رسید پرداخت از کاربر {user_id} در حافظه دریافت شد.")
             caption = (
-                f"📷 *رسید پرداخت از {user.name} (شناسه: {user.telegram_id})*\n"
+                f"📷 *رسید پرداخت از {_md_escape(user.name)} (شناسه: {user.telegram_id})*\n"
                 f"*شناسه ملاقات:* {appointment_id}\n\n"
                 f"لطفاً پرداخت را تأیید کنید."
             )
@@ -1317,28 +1754,26 @@ async def payment_receipt_handler(update: Update, context: ContextTypes.DEFAULT_
             return PAYMENT_RECEIPT
 
     try:
-        # Send the receipt to the developer
-        with open(file_path, 'rb') as receipt_file:
-            await context.bot.send_photo(
-                chat_id=DEVELOPER_CHAT_ID,
-                photo=receipt_file,
-                caption=caption,
-                parse_mode="Markdown"
-            )
+        # Relay the in-memory receipt to the developer — no disk round-trip.
+        await send_with_flood_control(
+            context.bot.send_photo,
+            chat_id=DEVELOPER_CHAT_ID,
+            photo=receipt_buf.getvalue(),
+            caption=caption,
+            parse_mode="Markdown"
+        )
         logger.info(
             f"توسعه‌دهنده در مورد رسید پرداخت از کاربر {user_id} برای ملاقات {appointment_id} مطلع شد."
         )
+
+        if ARCHIVE_RECEIPTS:
+            file_path = os.path.join(RECEIPTS_DIR, file_name)
+            await asyncio.to_thread(_write_receipt_archive, file_path, receipt_buf.getvalue())
+
         await update.message.reply_text("*✅ رسید دریافت شد و در حال بررسی است.*",
                                         parse_mode="Markdown",
                                         reply_markup=main_menu_keyboard(user_id))
 
-        # Optionally, remove the receipt file after sending
-        try:
-            os.remove(file_path)
-            logger.info(f"فایل رسید حذف شد: {file_path}")
-        except Exception as e:
-            logger.warning(f"ناتوان در حذف فایل رسید: {file_path}. خطا: {e}")
-
     except Exception as e:
         logger.error(f"خطا در ارسال رسید پرداخت به توسعه‌دهنده برای کاربر {user_id}: {e}")
         await update.message.reply_text("*❌ ارسال رسید به توسعه‌دهنده ناموفق بود. لطفاً دوباره تلاش کنید.*",
@@ -1355,103 +1790,137 @@ async def payment_receipt_handler(update: Update, context: ContextTypes.DEFAULT_
 # Developer Menu Handlers
 ##################
 
-async def developer_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    choice = update.message.text.strip()
-    logger.info(f"توسعه‌دهنده انتخاب کرد: {choice}")
+_MANAGE_SPECS_KB = ReplyKeyboardMarkup([["➕ افزودن تخصص"], ["➖ حذف تخصص"], ["🔙 بازگشت"]],
+                                       resize_keyboard=True)
 
-    if choice == "🗂 مدیریت تخصص‌ها":
-        kb = [["➕ افزودن تخصص"], ["➖ حذف تخصص"], ["🔙 بازگشت"]]
-        await update.message.reply_text("*🗂 مدیریت تخصص‌ها:*", parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
-        return DEV_MANAGE_SPECIALIZATIONS
 
-    elif choice == "➕ افزودن پزشک":
-        specs = get_specializations()
-        if not specs:
-            await update.message.reply_text("❌ *هیچ تخصصی موجود نیست.* لطفاً ابتدا یکی اضافه کنید.",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
-        await update.message.reply_text("*لطفاً تخصص برای پزشک جدید را انتخاب کنید:*",
-                                        parse_mode="Markdown",
-                                        reply_markup=specialization_keyboard())
-        return DEV_ADD_DOCTOR_CHOOSE_SPECIALIZATION
+async def _dev_manage_specs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("*🗂 مدیریت تخصص‌ها:*", parse_mode="Markdown",
+                                    reply_markup=_MANAGE_SPECS_KB)
+    return DEV_MANAGE_SPECIALIZATIONS
 
-    elif choice == "➖ حذف پزشک":
-        specs = get_specializations()
-        if not specs:
-            await update.message.reply_text("❌ *هیچ تخصصی موجود نیست.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
-        await update.message.reply_text("*لطفاً تخصصی را که می‌خواهید پزشک را از آن حذف کنید انتخاب کنید:*",
-                                        parse_mode="Markdown",
-                                        reply_markup=specialization_keyboard())
-        return DEV_REMOVE_SPECIALIZATION_SELECT
 
-    elif choice == "📊 مشاهده آمار":
-        await view_statistics(update, context)
+async def _dev_add_doctor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    specs = get_specializations()
+    if not specs:
+        await update.message.reply_text("❌ *هیچ تخصصی موجود نیست.* لطفاً ابتدا یکی اضافه کنید.",
+                                        parse_mode="Markdown",
+                                        reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
+    await update.message.reply_text("*لطفاً تخصص برای پزشک جدید را انتخاب کنید:*",
+                                    parse_mode="Markdown",
+                                    reply_markup=specialization_keyboard())
+    return DEV_ADD_DOCTOR_CHOOSE_SPECIALIZATION
 
-    elif choice == "📨 ارسال پیام به کاربر":
-        await update.message.reply_text(
-            "*📨 ارسال پیام به کاربر*\n\nلطفاً شناسه تلگرام کاربر و پیام خود را با فاصله وارد کنید:",
-            parse_mode="Markdown",
-            reply_markup=cancel_menu_keyboard())
-        return SEND_MESSAGE_TO_USER
-
-    elif choice == "🔙 بازگشت":
-        await update.message.reply_text("*🔙 بازگشت به منوی اصلی.*", parse_mode="Markdown",
-                                        reply_markup=main_menu_keyboard(DEVELOPER_CHAT_ID))
-        return MAIN_MENU
 
-    else:
-        await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منوی توسعه‌دهنده را انتخاب کنید.",
+async def _dev_remove_doctor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    specs = get_specializations()
+    if not specs:
+        await update.message.reply_text("❌ *هیچ تخصصی موجود نیست.*",
                                         parse_mode="Markdown",
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
+    await update.message.reply_text("*لطفاً تخصصی را که می‌خواهید پزشک را از آن حذف کنید انتخاب کنید:*",
+                                    parse_mode="Markdown",
+                                    reply_markup=specialization_keyboard())
+    return DEV_REMOVE_SPECIALIZATION_SELECT
+
+
+async def _dev_view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await view_statistics(update, context)
+    return DEVELOPER_MENU
+
+
+async def _dev_send_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(
+        "*📨 ارسال پیام به کاربر*\n\nلطفاً شناسه تلگرام کاربر و پیام خود را با فاصله وارد کنید:",
+        parse_mode="Markdown",
+        reply_markup=cancel_menu_keyboard())
+    return SEND_MESSAGE_TO_USER
+
+
+async def _dev_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("*🔙 بازگشت به منوی اصلی.*", parse_mode="Markdown",
+                                    reply_markup=main_menu_keyboard(DEVELOPER_CHAT_ID))
+    return MAIN_MENU
+
+
+# Hash lookup instead of a linear if/elif chain over the button labels.
+DEV_MENU_DISPATCH = {
+    "🗂 مدیریت تخصص‌ها": _dev_manage_specs,
+    "➕ افزودن پزشک": _dev_add_doctor,
+    "➖ حذف پزشک": _dev_remove_doctor,
+    "📊 مشاهده آمار": _dev_view_statistics,
+    "📨 ارسال پیام به کاربر": _dev_send_message,
+    "🔙 بازگشت": _dev_back_to_main,
+}
+
+
+async def developer_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    choice = update.message.text.strip()
+    logger.info(f"توسعه‌دهنده انتخاب کرد: {choice}")
+
+    handler = DEV_MENU_DISPATCH.get(choice)
+    if handler is not None:
+        return await handler(update, context)
+
+    await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منوی توسعه‌دهنده را انتخاب کنید.",
+                                    parse_mode="Markdown",
+                                    reply_markup=developer_menu_keyboard())
+    return DEVELOPER_MENU
 
 
 ##################
 # Developer: Manage Specializations
 ##################
 
-async def dev_manage_specializations(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    choice = update.message.text.strip()
+async def _manage_specs_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("*🆕 افزودن تخصص جدید*\n\nنام تخصص جدید را وارد کنید:",
+                                    parse_mode="Markdown",
+                                    reply_markup=back_cancel_menu_keyboard())
+    return DEV_ADD_SPECIALIZATION
 
-    if choice == "➕ افزودن تخصص":
-        await update.message.reply_text("*🆕 افزودن تخصص جدید*\n\nنام تخصص جدید را وارد کنید:",
-                                        parse_mode="Markdown",
-                                        reply_markup=back_cancel_menu_keyboard())
-        return DEV_ADD_SPECIALIZATION
 
-    elif choice == "➖ حذف تخصص":
-        specs = get_specializations()
-        if not specs:
-            await update.message.reply_text("*❌ تخصصی برای حذف وجود ندارد.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
-        kb = [[s] for s in specs]
-        kb.append(["🔙 بازگشت"])
-        await update.message.reply_text("*لطفاً تخصصی را که می‌خواهید حذف کنید انتخاب کنید:*",
+async def _manage_specs_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    specs = get_specializations()
+    if not specs:
+        await update.message.reply_text("*❌ تخصصی برای حذف وجود ندارد.*",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
-        return DEV_REMOVE_SPECIALIZATION_SELECT
-
-    elif choice == "🔙 بازگشت":
-        await update.message.reply_text("*🔙 بازگشت به منوی توسعه‌دهنده.*", parse_mode="Markdown",
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
+    await update.message.reply_text("*لطفاً تخصصی را که می‌خواهید حذف کنید انتخاب کنید:*",
+                                    parse_mode="Markdown",
+                                    reply_markup=specialization_keyboard())
+    return DEV_REMOVE_SPECIALIZATION_SELECT
+
+
+async def _manage_specs_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text("*🔙 بازگشت به منوی توسعه‌دهنده.*", parse_mode="Markdown",
+                                    reply_markup=developer_menu_keyboard())
+    return DEVELOPER_MENU
+
+
+MANAGE_SPECS_DISPATCH = {
+    "➕ افزودن تخصص": _manage_specs_add,
+    "➖ حذف تخصص": _manage_specs_remove,
+    "🔙 بازگشت": _manage_specs_back,
+}
+
 
-    elif choice == "❌ لغو":
+async def dev_manage_specializations(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    choice = update.message.text.strip()
+
+    if choice == "❌ لغو":
         return await cancel(update, context)
 
-    else:
-        await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منوی مدیریت تخصص‌ها را انتخاب کنید.",
-                                        parse_mode="Markdown",
-                                        reply_markup=developer_menu_keyboard())
-        return DEV_MANAGE_SPECIALIZATIONS
+    handler = MANAGE_SPECS_DISPATCH.get(choice)
+    if handler is not None:
+        return await handler(update, context)
+
+    await update.message.reply_text("❌ *انتخاب نامعتبر.* لطفاً یک گزینه از منوی مدیریت تخصص‌ها را انتخاب کنید.",
+                                    parse_mode="Markdown",
+                                    reply_markup=developer_menu_keyboard())
+    return DEV_MANAGE_SPECIALIZATIONS
 
 
 async def dev_add_specialization(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1471,25 +1940,32 @@ async def dev_add_specialization(update: Update, context: ContextTypes.DEFAULT_T
                                         reply_markup=back_cancel_menu_keyboard())
         return DEV_ADD_SPECIALIZATION
 
+    # All DB work happens before any await, so the session (and its pooled
+    # connection) is released before the Telegram round-trip.
+    inserted = False
     with Session() as session:
-        existing_spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if existing_spec:
-            await update.message.reply_text("*❌ تخصص قبلاً وجود دارد.* لطفاً یک نام متفاوت وارد کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=back_cancel_menu_keyboard())
-            return DEV_ADD_SPECIALIZATION
-        new_spec = Specialization(name=spec_name)
-        session.add(new_spec)
-        try:
-            session.commit()
-            logger.info(f"تخصص '{spec_name}' توسط توسعه‌دهنده اضافه شد.")
-        except IntegrityError as e:
-            logger.error(f"خطا در افزودن تخصص '{spec_name}': {e}")
-            session.rollback()
-            await update.message.reply_text("*❌ افزودن تخصص ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEV_MANAGE_SPECIALIZATIONS
+        spec_exists = session.query(Specialization.id).filter_by(name=spec_name).scalar() is not None
+        if not spec_exists:
+            session.add(Specialization(name=spec_name))
+            try:
+                session.commit()
+                inserted = True
+                invalidate_specializations()
+                logger.info(f"تخصص '{spec_name}' توسط توسعه‌دهنده اضافه شد.")
+            except IntegrityError as e:
+                logger.error(f"خطا در افزودن تخصص '{spec_name}': {e}")
+                session.rollback()
+
+    if spec_exists:
+        await update.message.reply_text("*❌ تخصص قبلاً وجود دارد.* لطفاً یک نام متفاوت وارد کنید:",
+                                        parse_mode="Markdown",
+                                        reply_markup=back_cancel_menu_keyboard())
+        return DEV_ADD_SPECIALIZATION
+    if not inserted:
+        await update.message.reply_text("*❌ افزودن تخصص ناموفق بود. لطفاً دوباره تلاش کنید.*",
+                                        parse_mode="Markdown",
+                                        reply_markup=developer_menu_keyboard())
+        return DEV_MANAGE_SPECIALIZATIONS
 
     await update.message.reply_text(f"✅ *تخصص '{spec_name}' با موفقیت اضافه شد.*",
                                     parse_mode="Markdown",
@@ -1505,88 +1981,119 @@ async def dev_remove_specialization_select(update: Update, context: ContextTypes
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
 
-    with Session() as session:
-        spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if not spec:
-            await update.message.reply_text("*❌ تخصص پیدا نشد.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
-        # Store specialization ID in context
-        context.user_data['remove_specialization_id'] = spec.id
+    spec_id = get_specialization_id(spec_name)
+    if spec_id is None:
+        await update.message.reply_text("*❌ تخصص پیدا نشد.*",
+                                        parse_mode="Markdown",
+                                        reply_markup=developer_menu_keyboard())
+        return DEVELOPER_MENU
+    # Store specialization ID in context
+    context.user_data['remove_specialization_id'] = spec_id
 
-        # Ask for confirmation to remove. **We WILL remove it even if appointments are active.**
-        await update.message.reply_text(
-            f"⚠️ *آیا مطمئنید که می‌خواهید تخصص '{spec_name}' را حذف کنید؟*\n\n"
-            f"همه پزشکان مرتبط و ملاقات‌هایشان (حتی اگر فعال باشند) لغو و حذف خواهند شد.",
-            parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup([["بله", "خیر"]], resize_keyboard=True)
-        )
+    # Ask for confirmation to remove. **We WILL remove it even if appointments are active.**
+    await update.message.reply_text(
+        f"⚠️ *آیا مطمئنید که می‌خواهید تخصص '{spec_name}' را حذف کنید؟*\n\n"
+        f"همه پزشکان مرتبط و ملاقات‌هایشان (حتی اگر فعال باشند) لغو و حذف خواهند شد.",
+        parse_mode="Markdown",
+        reply_markup=_YES_NO_KB
+    )
     return CONFIRM_REMOVE_SPEC
 
 
+def _remove_specialization(spec_id):
+    """Deletes a specialization with its doctors and appointments in one
+    transaction, entirely on the calling (worker) thread.
+
+    Returns (spec_name, doctor_names, notify_rows) for the post-commit
+    notifications, or None if the specialization no longer exists.
+    IntegrityError propagates to the caller after rollback."""
+    with Session() as session:
+        spec = session.get(Specialization, spec_id)
+        if spec is None:
+            return None
+
+        spec_name = spec.name
+        doctor_rows = session.query(Doctor.id, Doctor.name).filter(
+            Doctor.specialization_id == spec_id
+        ).all()
+        doctor_ids = [row.id for row in doctor_rows]
+        doctor_names = {row.id: row.name for row in doctor_rows}
+
+        # Snapshot everything the notifications need BEFORE the bulk
+        # deletes: synchronize_session=False bypasses the identity map,
+        # so the ORM objects would be stale afterwards.
+        notify_rows = []
+        if doctor_ids:
+            notify_rows = (
+                session.query(Appointment.id, Appointment.doctor_id, User.telegram_id)
+                .join(User, Appointment.user_id == User.id)
+                .filter(Appointment.doctor_id.in_(doctor_ids),
+                        Appointment.status.in_(["pending", "confirmed"]))
+                .all()
+            )
+
+        try:
+            # Two set-based DELETEs instead of one round-trip per row.
+            if doctor_ids:
+                session.query(Appointment).filter(
+                    Appointment.doctor_id.in_(doctor_ids)
+                ).delete(synchronize_session=False)
+                session.query(Doctor).filter(
+                    Doctor.id.in_(doctor_ids)
+                ).delete(synchronize_session=False)
+            session.delete(spec)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise
+        invalidate_statistics()
+    return spec_name, doctor_names, notify_rows
+
+
 async def confirm_remove_spec(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     confirmation = update.message.text.strip()
 
     if confirmation == "بله":
         spec_id = context.user_data.get('remove_specialization_id')
-        with Session() as session:
-            spec = session.query(Specialization).filter_by(id=spec_id).first()
-            if not spec:
-                await update.message.reply_text(
-                    "❌ تخصص پیدا نشد.",
-                    parse_mode="Markdown",
-                    reply_markup=developer_menu_keyboard()
-                )
-                return DEVELOPER_MENU
-
-            # ----------------------------------------------------------------
-            # 1) For each doctor in the specialization, delete ALL appointments
-            # ----------------------------------------------------------------
-            for doctor in spec.doctors:
-                appointments = session.query(Appointment).filter_by(doctor_id=doctor.id).all()
-
-                for appt in appointments:
-                    # If you'd like to notify users, do so here:
-                    if appt.status in ["pending", "confirmed"]:
-                        try:
-                            await context.bot.send_message(
-                                chat_id=appt.user.telegram_id,
-                                text=(
-                                    f"⚠️ *ملاقات لغو شد*\n\n"
-                                    f"ملاقات شما (شناسه: {appt.id}) با دکتر {doctor.name} "
-                                    f"به دلیل حذف تخصص '{spec.name}' حذف شده است."
-                                ),
-                                parse_mode="Markdown"
-                            )
-                        except Exception as e:
-                            logger.error(f"خطا در اطلاع‌رسانی به کاربر {appt.user.telegram_id}: {e}")
-
-                    # Physically remove the appointment from DB
-                    session.delete(appt)
-
-                # 2) Delete the Doctor
-                session.delete(doctor)
-
-            # 3) Finally, delete the Specialization
-            session.delete(spec)
+        try:
+            removed = await run_db(_remove_specialization, spec_id)
+        except IntegrityError as e:
+            logger.error(f"خطا در حذف تخصص {spec_id}: {e}")
+            await update.message.reply_text(
+                "❌ حذف تخصص ناموفق بود. لطفاً دوباره تلاش کنید.",
+                parse_mode="Markdown",
+                reply_markup=developer_menu_keyboard()
+            )
+            context.user_data.pop('remove_specialization_id', None)
+            return DEVELOPER_MENU
 
-            try:
-                session.commit()
-                logger.info(f"تخصص '{spec.name}' و پزشکان و ملاقات‌های مرتبط حذف شدند.")
-                await update.message.reply_text(
-                    f"✅ تخصص '{spec.name}' و تمامی پزشکان و ملاقات‌های مرتبط حذف شدند.",
-                    parse_mode="Markdown",
-                    reply_markup=developer_menu_keyboard()
-                )
-            except IntegrityError as e:
-                session.rollback()
-                logger.error(f"خطا در حذف تخصص '{spec.name}': {e}")
-                await update.message.reply_text(
-                    "❌ حذف تخصص ناموفق بود. لطفاً دوباره تلاش کنید.",
-                    parse_mode="Markdown",
-                    reply_markup=developer_menu_keyboard()
-                )
+        if removed is None:
+            await update.message.reply_text(
+                "❌ تخصص پیدا نشد.",
+                parse_mode="Markdown",
+                reply_markup=developer_menu_keyboard()
+            )
+            return DEVELOPER_MENU
+
+        spec_name, doctor_names, notify_rows = removed
+        invalidate_specializations()
+        logger.info(f"تخصص '{spec_name}' و پزشکان و ملاقات‌های مرتبط حذف شدند.")
+
+        # Notify affected users after the transaction is committed.
+        if notify_rows:
+            await broadcast(context.bot, [
+                (telegram_id,
+                 f"⚠️ *ملاقات لغو شد*\n\n"
+                 f"ملاقات شما (شناسه: {appt_id}) با دکتر {_md_escape(doctor_names[doctor_id])} "
+                 f"به دلیل حذف تخصص '{_md_escape(spec_name)}' حذف شده است.")
+                for appt_id, doctor_id, telegram_id in notify_rows
+            ])
+
+        await update.message.reply_text(
+            f"✅ تخصص '{_md_escape(spec_name)}' و تمامی پزشکان و ملاقات‌های مرتبط حذف شدند.",
+            parse_mode="Markdown",
+            reply_markup=developer_menu_keyboard()
+        )
 
         # Cleanup context
         context.user_data.pop('remove_specialization_id', None)
@@ -1605,7 +2112,7 @@ async def confirm_remove_spec(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text(
             "لطفاً 'بله' یا 'خیر' را انتخاب کنید.",
             parse_mode="Markdown",
-            reply_markup=ReplyKeyboardMarkup([["بله", "خیر"]], resize_keyboard=True)
+            reply_markup=_YES_NO_KB
         )
         return CONFIRM_REMOVE_SPEC
 
@@ -1622,14 +2129,13 @@ async def dev_add_doctor_choose_specialization(update: Update, context: ContextT
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
 
-    with Session() as session:
-        spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if not spec:
-            await update.message.reply_text("*❌ تخصص پیدا نشد.* لطفاً دوباره انتخاب کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=specialization_keyboard())
-            return DEV_ADD_DOCTOR_CHOOSE_SPECIALIZATION
-    context.user_data['add_doctor_specialization_id'] = spec.id
+    spec_id = get_specialization_id(spec_name)
+    if spec_id is None:
+        await update.message.reply_text("*❌ تخصص پیدا نشد.* لطفاً دوباره انتخاب کنید:",
+                                        parse_mode="Markdown",
+                                        reply_markup=specialization_keyboard())
+        return DEV_ADD_DOCTOR_CHOOSE_SPECIALIZATION
+    context.user_data['add_doctor_specialization_id'] = spec_id
     await update.message.reply_text("*🆕 نام پزشک را وارد کنید:*",
                                     parse_mode="Markdown",
                                     reply_markup=back_cancel_menu_keyboard())
@@ -1653,24 +2159,20 @@ async def dev_add_doctor_name(update: Update, context: ContextTypes.DEFAULT_TYPE
                                         reply_markup=back_cancel_menu_keyboard())
         return DEV_ADD_DOCTOR_NAME
 
+    spec_id = context.user_data.get('add_doctor_specialization_id')
     with Session() as session:
-        spec_id = context.user_data.get('add_doctor_specialization_id')
-        existing_doc = session.query(Doctor).filter_by(name=doc_name, specialization_id=spec_id).first()
-        if existing_doc:
-            await update.message.reply_text(
-                "*❌ پزشک در این تخصص قبلاً وجود دارد.* لطفاً یک نام متفاوت وارد کنید:",
-                parse_mode="Markdown",
-                reply_markup=back_cancel_menu_keyboard())
-            return DEV_ADD_DOCTOR_NAME
+        doc_exists = session.query(Doctor.id).filter_by(name=doc_name, specialization_id=spec_id).scalar() is not None
+    if doc_exists:
+        await update.message.reply_text(
+            "*❌ پزشک در این تخصص قبلاً وجود دارد.* لطفاً یک نام متفاوت وارد کنید:",
+            parse_mode="Markdown",
+            reply_markup=back_cancel_menu_keyboard())
+        return DEV_ADD_DOCTOR_NAME
 
     context.user_data['add_doctor_name'] = doc_name
     # Ask for availability
     await update.message.reply_text("*🕒 دسترسی پزشک را انتخاب کنید:*", parse_mode="Markdown",
-                                    reply_markup=ReplyKeyboardMarkup(
-                                        [["حضوری"], ["آنلاین"], ["هر دو"], ["🔙 بازگشت", "❌ لغو"]],
-                                        resize_keyboard=True,
-                                        one_time_keyboard=True
-                                    ))
+                                    reply_markup=_AVAILABILITY_KB)
     return DEV_ADD_DOCTOR_AVAILABILITY
 
 
@@ -1685,65 +2187,42 @@ async def dev_add_doctor_availability(update: Update, context: ContextTypes.DEFA
     if availability_choice == "❌ لغو":
         return await cancel(update, context)
 
-    valid_choices = ["حضوری", "آنلاین", "هر دو"]
-    if availability_choice not in valid_choices:
+    flags = _AVAILABILITY_FLAGS.get(availability_choice)
+    if flags is None:
         await update.message.reply_text("*❌ انتخاب نامعتبر.* لطفاً از گزینه‌های موجود انتخاب کنید:",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["حضوری"], ["آنلاین"], ["هر دو"], ["🔙 بازگشت", "❌ لغو"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=_AVAILABILITY_KB)
         return DEV_ADD_DOCTOR_AVAILABILITY
+    in_person, online, label = flags
 
     spec_id = context.user_data.get('add_doctor_specialization_id')
     doc_name = context.user_data.get('add_doctor_name')
 
+    inserted = False
     with Session() as session:
-        if availability_choice == "هر دو":
-            # Create a single doctor with both availabilities
-            doctor = Doctor(
-                name=doc_name,
-                specialization_id=spec_id,
-                in_person_available=True,
-                online_available=True
-            )
-            session.add(doctor)
-            success_message = f"✅ *پزشک '{doc_name}' با دسترسی حضوری و آنلاین اضافه شد.*"
-            logger.info(f"توسعه‌دهنده پزشک '{doc_name}' را با دسترسی حضوری و آنلاین اضافه کرد.")
-        elif availability_choice == "حضوری":
-            doctor = Doctor(
-                name=doc_name,
-                specialization_id=spec_id,
-                in_person_available=True,
-                online_available=False
-            )
-            session.add(doctor)
-            success_message = f"✅ *پزشک '{doc_name}' با دسترسی حضوری اضافه شد.*"
-            logger.info(f"توسعه‌دهنده پزشک '{doc_name}' را با دسترسی حضوری اضافه کرد.")
-        elif availability_choice == "آنلاین":
-            doctor = Doctor(
-                name=doc_name,
-                specialization_id=spec_id,
-                in_person_available=False,
-                online_available=True
-            )
-            session.add(doctor)
-            success_message = f"✅ *پزشک '{doc_name}' با دسترسی آنلاین اضافه شد.*"
-            logger.info(f"توسعه‌دهنده پزشک '{doc_name}' را با دسترسی آنلاین اضافه کرد.")
-
+        session.add(Doctor(
+            name=doc_name,
+            specialization_id=spec_id,
+            in_person_available=in_person,
+            online_available=online
+        ))
         try:
             session.commit()
-            await update.message.reply_text(success_message,
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
+            inserted = True
+            logger.info(f"توسعه‌دهنده پزشک '{doc_name}' را با دسترسی {label} اضافه کرد.")
         except IntegrityError as e:
             logger.error(f"خطا در افزودن پزشک '{doc_name}': {e}")
             session.rollback()
-            await update.message.reply_text("*❌ افزودن پزشک ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
+
+    if not inserted:
+        await update.message.reply_text("*❌ افزودن پزشک ناموفق بود. لطفاً دوباره تلاش کنید.*",
+                                        parse_mode="Markdown",
+                                        reply_markup=developer_menu_keyboard())
+        return DEVELOPER_MENU
+
+    await update.message.reply_text(f"✅ *پزشک '{doc_name}' با دسترسی {label} اضافه شد.*",
+                                    parse_mode="Markdown",
+                                    reply_markup=developer_menu_keyboard())
 
     # Clear temporary data
     context.user_data.pop('add_doctor_specialization_id', None)
@@ -1763,22 +2242,23 @@ async def dev_remove_doctor_choose_specialization(update: Update, context: Conte
                                         reply_markup=developer_menu_keyboard())
         return DEVELOPER_MENU
 
+    spec_id = get_specialization_id(spec_name)
+    if spec_id is None:
+        await update.message.reply_text("*❌ تخصص پیدا نشد.* لطفاً دوباره انتخاب کنید:",
+                                        parse_mode="Markdown",
+                                        reply_markup=specialization_keyboard())
+        return DEV_REMOVE_SPECIALIZATION_SELECT
     with Session() as session:
-        spec = session.query(Specialization).filter_by(name=spec_name).first()
-        if not spec:
-            await update.message.reply_text("*❌ تخصص پیدا نشد.* لطفاً دوباره انتخاب کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=specialization_keyboard())
-            return DEV_REMOVE_SPECIALIZATION_SELECT
-        doctors = session.query(Doctor).filter_by(specialization_id=spec.id).all()
-        if not doctors:
-            await update.message.reply_text("*❌ هیچ پزشکی در این تخصص موجود نیست.*",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
+        doctor_names = [row[0] for row in
+                        session.query(Doctor.name).filter_by(specialization_id=spec_id).all()]
+    if not doctor_names:
+        await update.message.reply_text("*❌ هیچ پزشکی در این تخصص موجود نیست.*",
+                                        parse_mode="Markdown",
+                                        reply_markup=developer_menu_keyboard())
+        return DEVELOPER_MENU
 
-    context.user_data['remove_doctor_specialization_id'] = spec.id
-    keyboard = [[doc.name] for doc in doctors]
+    context.user_data['remove_doctor_specialization_id'] = spec_id
+    keyboard = [[name] for name in doctor_names]
     keyboard.append(["🔙 بازگشت"])
     await update.message.reply_text("*لطفاً پزشکی را که می‌خواهید حذف کنید انتخاب کنید:*",
                                     parse_mode="Markdown",
@@ -1794,70 +2274,102 @@ async def DEV_REMOVE_DOCTOR_SELECT(update: Update, context: ContextTypes.DEFAULT
                                         reply_markup=specialization_keyboard())
         return DEV_REMOVE_SPECIALIZATION_SELECT
 
+    spec_id = context.user_data.get('remove_doctor_specialization_id')
     with Session() as session:
-        spec_id = context.user_data.get('remove_doctor_specialization_id')
-        doctor = session.query(Doctor).filter_by(name=doc_name, specialization_id=spec_id).first()
-        if not doctor:
-            await update.message.reply_text("*❌ پزشک پیدا نشد.* لطفاً دوباره انتخاب کنید:",
-                                            parse_mode="Markdown",
-                                            reply_markup=developer_menu_keyboard())
-            return DEVELOPER_MENU
-        # Optionally, confirm deletion
-        await update.message.reply_text(f"⚠️ *آیا مطمئنید که می‌خواهید پزشک '{doctor.name}' را حذف کنید؟*\n\n"
-                                        f"تمام ملاقات‌های مرتبط لغو خواهند شد.",
+        doctor_id = session.query(Doctor.id).filter_by(name=doc_name, specialization_id=spec_id).scalar()
+    if doctor_id is None:
+        await update.message.reply_text("*❌ پزشک پیدا نشد.* لطفاً دوباره انتخاب کنید:",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup([["بله", "خیر"]], resize_keyboard=True))
-        context.user_data['remove_doctor_id'] = doctor.id
+                                        reply_markup=developer_menu_keyboard())
+        return DEVELOPER_MENU
+    context.user_data['remove_doctor_id'] = doctor_id
+    # Optionally, confirm deletion
+    await update.message.reply_text(f"⚠️ *آیا مطمئنید که می‌خواهید پزشک '{doc_name}' را حذف کنید؟*\n\n"
+                                    f"تمام ملاقات‌های مرتبط لغو خواهند شد.",
+                                    parse_mode="Markdown",
+                                    reply_markup=_YES_NO_KB)
     return CONFIRM_REMOVE_DOCTOR
 
 
+def _remove_doctor(doctor_id):
+    """Cancels a doctor's open appointments and deletes the doctor in one
+    transaction, entirely on the calling (worker) thread.
+
+    Returns (doctor_name, notify_rows) for the post-commit notifications,
+    or None if the doctor no longer exists. IntegrityError propagates to
+    the caller after rollback."""
+    with Session() as session:
+        doctor = session.get(Doctor, doctor_id)
+        if doctor is None:
+            return None
+
+        doctor_name = doctor.name
+        # Snapshot notification targets before the bulk UPDATE; the
+        # rows are rewritten without going through the identity map.
+        notify_rows = (
+            session.query(Appointment.id, User.telegram_id)
+            .join(User, Appointment.user_id == User.id)
+            .filter(Appointment.doctor_id == doctor.id,
+                    Appointment.status.in_(["pending", "confirmed"]))
+            .all()
+        )
+
+        # Single set-based UPDATE instead of one flush per row.
+        canceled = session.query(Appointment).filter(
+            Appointment.doctor_id == doctor.id,
+            Appointment.status.in_(["pending", "confirmed"])
+        ).update({Appointment.status: "canceled"}, synchronize_session=False)
+        logger.info(f"{canceled} ملاقات مرتبط با پزشک {doctor.id} به 'لغو شده' تغییر وضعیت داد.")
+
+        session.delete(doctor)
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            raise
+        invalidate_statistics()
+    return doctor_name, notify_rows
+
+
 async def confirm_remove_doctor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     confirmation = update.message.text.strip()
 
     if confirmation == "بله":
         doctor_id = context.user_data.get('remove_doctor_id')
-        with Session() as session:
-            doctor = session.query(Doctor).filter_by(id=doctor_id).first()
-            if doctor:
-                # Handle appointments before deleting the doctor
-                appointments = session.query(Appointment).filter_by(doctor_id=doctor.id).all()
-                for appt in appointments:
-                    if appt.status in ['pending', 'confirmed']:
-                        # Notify the user about the cancellation
-                        try:
-                            await context.bot.send_message(
-                                chat_id=appt.user.telegram_id,
-                                text=(
-                                    f"⚠️ *ملاقات لغو شد*\n\n"
-                                    f"ملاقات شما (شناسه: {appt.id}) با *دکتر {doctor.name}* به دلیل حذف پزشک از سیستم لغو شده است.\n\n"
-                                    f"لطفاً برای تنظیم مجدد یا انتخاب پزشک دیگر با ما تماس بگیرید."
-                                ),
-                                parse_mode="Markdown"
-                            )
-                        except Exception as e:
-                            logger.error(f"خطا در اطلاع‌رسانی به کاربر {appt.user.telegram_id} در مورد لغو ملاقات: {e}")
-                    # Set appointment status to 'canceled'
-                    appt.status = 'canceled'
-                    logger.info(f"ملاقات {appt.id} مرتبط با پزشک {doctor.id} به 'لغو شده' تغییر وضعیت داد.")
-
-                session.delete(doctor)
-                try:
-                    session.commit()
-                    logger.info(f"پزشک '{doctor.name}' توسط توسعه‌دهنده حذف شد.")
-                    await update.message.reply_text(
-                        f"✅ *پزشک '{doctor.name}' حذف شد.*\nتمام ملاقات‌های مرتبط لغو شده‌اند.",
-                        parse_mode="Markdown",
-                        reply_markup=developer_menu_keyboard())
-                except IntegrityError as e:
-                    logger.error(f"خطا در حذف پزشک '{doctor.name}': {e}")
-                    session.rollback()
-                    await update.message.reply_text("*❌ حذف پزشک ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                                    parse_mode="Markdown",
-                                                    reply_markup=developer_menu_keyboard())
-            else:
-                await update.message.reply_text("*❌ پزشک پیدا نشد.*",
-                                                parse_mode="Markdown",
-                                                reply_markup=developer_menu_keyboard())
+        try:
+            removed = await run_db(_remove_doctor, doctor_id)
+        except IntegrityError as e:
+            logger.error(f"خطا در حذف پزشک {doctor_id}: {e}")
+            await update.message.reply_text("*❌ حذف پزشک ناموفق بود. لطفاً دوباره تلاش کنید.*",
+                                            parse_mode="Markdown",
+                                            reply_markup=developer_menu_keyboard())
+            context.user_data.pop('remove_doctor_id', None)
+            return DEVELOPER_MENU
+
+        if removed is None:
+            await update.message.reply_text("*❌ پزشک پیدا نشد.*",
+                                            parse_mode="Markdown",
+                                            reply_markup=developer_menu_keyboard())
+            context.user_data.pop('remove_doctor_id', None)
+            return DEVELOPER_MENU
+
+        doctor_name, notify_rows = removed
+        logger.info(f"پزشک '{doctor_name}' توسط توسعه‌دهنده حذف شد.")
+        await update.message.reply_text(
+            f"✅ *پزشک '{_md_escape(doctor_name)}' حذف شد.*\nتمام ملاقات‌های مرتبط لغو شده‌اند.",
+            parse_mode="Markdown",
+            reply_markup=developer_menu_keyboard())
+
+        # Notify affected users after the transaction is committed.
+        if notify_rows:
+            await broadcast(context.bot, [
+                (telegram_id,
+                 f"⚠️ *ملاقات لغو شد*\n\n"
+                 f"ملاقات شما (شناسه: {appt_id}) با *دکتر {_md_escape(doctor_name)}* به دلیل حذف پزشک از سیستم لغو شده است.\n\n"
+                 f"لطفاً برای تنظیم مجدد یا انتخاب پزشک دیگر با ما تماس بگیرید.")
+                for appt_id, telegram_id in notify_rows
+            ])
+
         context.user_data.pop('remove_doctor_id', None)
         return DEVELOPER_MENU
 
@@ -1871,7 +2383,7 @@ async def confirm_remove_doctor(update: Update, context: ContextTypes.DEFAULT_TY
     else:
         await update.message.reply_text("*لطفاً 'بله' یا 'خیر' را انتخاب کنید.*",
                                         parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup([["بله", "خیر"]], resize_keyboard=True))
+                                        reply_markup=_YES_NO_KB)
         return CONFIRM_REMOVE_DOCTOR
 
 
@@ -1879,19 +2391,56 @@ async def confirm_remove_doctor(update: Update, context: ContextTypes.DEFAULT_TY
 # Developer: View Statistics
 ##################
 
-async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# Counter snapshot for the statistics screen. The developer view tolerates
+# slightly stale numbers, so repeated keypresses within the TTL reuse the
+# last aggregate result instead of re-scanning both tables. Write paths
+# that change the counters call invalidate_statistics().
+STATS_CACHE_TTL = 60
+_STATS_CACHE = {"value": None, "expires": 0.0}
+
+
+def invalidate_statistics():
+    """Drops the cached statistics snapshot after a count-changing write."""
+    _STATS_CACHE["value"] = None
+    _STATS_CACHE["expires"] = 0.0
+
+
+def _load_statistics():
+    """Collects the developer statistics in three aggregate SELECTs.
+
+    Conditional aggregation (count + sum-of-case) folds the per-status
+    counts into one round-trip per table instead of one per counter.
+    Results are cached for STATS_CACHE_TTL seconds."""
+    if _STATS_CACHE["value"] is not None and time.monotonic() < _STATS_CACHE["expires"]:
+        return _STATS_CACHE["value"]
     with Session() as session:
-        total_users = session.query(User).count()
-        total_appointments = session.query(Appointment).count()
-        pending_appointments = session.query(Appointment).filter_by(status='pending').count()
-        confirmed_appointments = session.query(Appointment).filter_by(status='confirmed').count()
-        canceled_appointments = session.query(Appointment).filter_by(status='canceled').count()
-        rejected_appointments = session.query(Appointment).filter_by(status='rejected').count()
-
-        total_certificates = session.query(HealthCertificate).count()
-        pending_certificates = session.query(HealthCertificate).filter_by(status='pending').count()
-        approved_certificates = session.query(HealthCertificate).filter_by(status='approved').count()
-        rejected_certificates = session.query(HealthCertificate).filter_by(status='rejected').count()
+        total_users = session.query(func.count(User.id)).scalar()
+        appt_row = session.query(
+            func.count(Appointment.id),
+            func.sum(case((Appointment.status == 'pending', 1), else_=0)),
+            func.sum(case((Appointment.status == 'confirmed', 1), else_=0)),
+            func.sum(case((Appointment.status == 'canceled', 1), else_=0)),
+            func.sum(case((Appointment.status == 'rejected', 1), else_=0)),
+        ).one()
+        cert_row = session.query(
+            func.count(HealthCertificate.id),
+            func.sum(case((HealthCertificate.status == 'pending', 1), else_=0)),
+            func.sum(case((HealthCertificate.status == 'approved', 1), else_=0)),
+            func.sum(case((HealthCertificate.status == 'rejected', 1), else_=0)),
+        ).one()
+    # SUM over an empty table yields NULL, not 0.
+    result = (total_users, [v or 0 for v in appt_row], [v or 0 for v in cert_row])
+    _STATS_CACHE["value"] = result
+    _STATS_CACHE["expires"] = time.monotonic() + STATS_CACHE_TTL
+    return result
+
+
+async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    total_users, appt_row, cert_row = await run_db(_load_statistics)
+    (total_appointments, pending_appointments, confirmed_appointments,
+     canceled_appointments, rejected_appointments) = appt_row
+    (total_certificates, pending_certificates, approved_certificates,
+     rejected_certificates) = cert_row
 
     msg = (
         f"*📊 آمار*\n\n"
@@ -1915,19 +2464,14 @@ async def view_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def send_message_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_input = update.message.text.strip()
-    parts = user_input.split(' ', 1)
-    if len(parts) < 2:
+    match = SEND_MSG_REGEX.match(user_input)
+    if match is None:
         await update.message.reply_text("*❌ فرمت نامعتبر.*\n*نحوه استفاده:* `<شناسه کاربر> <پیام>`",
                                         parse_mode="Markdown")
         return DEVELOPER_MENU
 
-    try:
-        target_user_id = int(parts[0])
-        message = parts[1]
-    except ValueError:
-        await update.message.reply_text("*❌ شناسه کاربر باید یک عدد باشد.*",
-                                        parse_mode="Markdown")
-        return DEVELOPER_MENU
+    target_user_id = int(match[1])
+    message = match[2]
 
     try:
         await context.bot.send_message(chat_id=target_user_id, text=message)
@@ -1970,7 +2514,7 @@ async def send_message_to_developer(update: Update, context: ContextTypes.DEFAUL
     try:
         await context.bot.send_message(
             chat_id=DEVELOPER_CHAT_ID,
-            text=f"✉️ *پیام از کاربر (شناسه: {update.effective_user.id}):*\n\n{message}",
+            text=f"✉️ *پیام از کاربر (شناسه: {update.effective_user.id}):*\n\n{_md_escape(message)}",
             parse_mode="Markdown"
         )
         logger.info(f"کاربر {update.effective_user.id} پیام به توسعه‌دهنده ارسال کرد.")
@@ -1993,272 +2537,272 @@ async def send_message_to_developer(update: Update, context: ContextTypes.DEFAUL
 async def developer_action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data = query.data
-
-    if data.startswith("confirm_appt_"):
-        appt_id = int(data.split("_")[2])
-        await confirm_appointment(update, context, appt_id)
-    elif data.startswith("reject_appt_"):
-        appt_id = int(data.split("_")[2])
-        await reject_appointment(update, context, appt_id)
-    elif data.startswith("approve_cert_"):
-        cert_id = int(data.split("_")[2])
-        await approve_certificate(update, context, cert_id)
-    elif data.startswith("reject_cert_"):
-        cert_id = int(data.split("_")[2])
-        await reject_certificate(update, context, cert_id)
-
-
-async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, appt_id: int):
-    query = update.callback_query
-    logger.debug(f"توسعه‌دهنده در حال تأیید ملاقات شناسه: {appt_id}")
 
-    with Session() as session:
-        appt = session.query(Appointment).filter_by(id=appt_id).first()
-        if appt and appt.status == 'pending':
-            appt.status = 'confirmed'
-            try:
-                session.commit()
-                logger.info(f"ملاقات {appt_id} تأیید شد.")
-            except IntegrityError as e:
-                logger.error(f"خطا در تأیید ملاقات {appt_id}: {e}")
-                session.rollback()
-                await query.edit_message_text("*❌ تأیید ملاقات ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                              parse_mode="Markdown")
-                return
-            user = appt.user
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=(
-                        f"✅ *ملاقات شما (شناسه: {appt_id}) تأیید شد.*\n\n"
-                        f"• *پزشک:* {appt.doctor.name}\n"
-                        f"• *تخصص:* {appt.appointment_type}\n"
-                        f"• *روش ارتباط:* {appt.contact_method}\n\n"
-                        f"از انتخاب *Doctor Line* متشکریم!"
-                    ),
-                    parse_mode="Markdown"
-                )
-                logger.info(f"کاربر {user.telegram_id} در مورد تأیید ملاقات مطلع شد.")
-            except Exception as e:
-                logger.error(f"خطا در اطلاع‌رسانی به کاربر {user.telegram_id} در مورد تأیید ملاقات: {e}")
+    # Callback data is "<action>_<id>"; one rpartition + dict lookup routes
+    # it instead of a startswith ladder. The table lives below, after the
+    # action callbacks are defined.
+    action, _, item_id = query.data.rpartition("_")
+    spec = DEV_ACTION_DISPATCH.get(action)
+    if spec is not None:
+        await handle_transition(update, context, int(item_id), spec)
 
-            # Send confirmation email to user
-            email_subject = "✅ ملاقات تأیید شد"
-            email_body = (
-                f"سلام {user.name},\n\n"
-                f"خبر خوب! درخواست ملاقات شما (شناسه: {appt_id}) با *دکتر {appt.doctor.name}* تأیید شد.\n\n"
-                f"• *تخصص:* {appt.appointment_type}\n"
-                f"• *روش ارتباط:* {appt.contact_method}\n\n"
-                f"منتظر کمک به شما هستیم.\n\n"
-                f"📅 *تاریخ ملاقات:* {appt.created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-                f"از انتخاب *Doctor Line* متشکریم.\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-            send_email(user.email, email_subject, email_body)
 
-            await query.edit_message_text(
-                text=f"✅ *ملاقات {appt_id} تأیید شد.*\n*کاربر:* {user.name}\n*پزشک:* {appt.doctor.name}",
-                parse_mode="Markdown"
-            )
-        else:
-            logger.warning(f"ملاقات {appt_id} نامعتبر یا قبلاً پردازش شده است.")
-            await query.edit_message_text("*❌ شناسه ملاقات نامعتبر یا قبلاً پردازش شده است.*",
-                                          parse_mode="Markdown")
+_MD_SPECIALS = re.compile(r"([_*`\[])")
 
 
-async def reject_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE, appt_id: int):
-    query = update.callback_query
-    logger.debug(f"توسعه‌دهنده در حال رد ملاقات شناسه: {appt_id}")
+def _md_escape(value):
+    """Escape legacy-Markdown metacharacters in user-supplied text.
 
-    with Session() as session:
-        appt = session.query(Appointment).filter_by(id=appt_id).first()
-        if appt and appt.status == 'pending':
-            appt.status = 'rejected'
-            try:
-                session.commit()
-                logger.info(f"ملاقات {appt_id} رد شد.")
-            except IntegrityError as e:
-                logger.error(f"خطا در رد ملاقات {appt_id}: {e}")
-                session.rollback()
-                await query.edit_message_text("*❌ رد ملاقات ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                              parse_mode="Markdown")
-                return
-            user = appt.user
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=f"❌ *ملاقات شما (شناسه: {appt_id}) رد شد.*"
-                )
-                logger.info(f"کاربر {user.telegram_id} در مورد رد ملاقات مطلع شد.")
-            except Exception as e:
-                logger.error(f"خطا در اطلاع‌رسانی به کاربر {user.telegram_id} در مورد رد ملاقات: {e}")
-
-            # Send rejection email to user
-            email_subject = "❌ ملاقات رد شد"
-            email_body = (
-                f"سلام {user.name},\n\n"
-                f"با تاسف اعلام می‌کنیم که درخواست ملاقات شما (شناسه: {appt_id}) "
-                f"با *دکتر {appt.doctor.name}* رد شده است.\n\n"
-                f"اگر فکر می‌کنید این اشتباه است یا می‌خواهید مجدداً تنظیم کنید، لطفاً با ما تماس بگیرید.\n\n"
-                f"از درک شما متشکریم.\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-            send_email(user.email, email_subject, email_body)
+    Names, reasons, and descriptions are free-form; an unpaired '_' or
+    '*' makes Telegram reject the whole message with a 400 parse error,
+    which then burns a retry. Literal text in our own templates stays
+    unescaped.
+    """
+    return _MD_SPECIALS.sub(r"\\\1", str(value))
 
-            await query.edit_message_text(
-                text=f"❌ *ملاقات {appt_id} رد شد.*\n*کاربر:* {user.name}",
-                parse_mode="Markdown"
-            )
-        else:
-            logger.warning(f"ملاقات {appt_id} نامعتبر یا قبلاً پردازش شده است.")
-            await query.edit_message_text("*❌ شناسه ملاقات نامعتبر یا قبلاً پردازش شده است.*",
-                                          parse_mode="Markdown")
 
+def _appt_approved_texts(appt_id, appt):
+    """User notice and developer ack for an approved appointment."""
+    return (
+        (
+            f"✅ *ملاقات شما (شناسه: {appt_id}) تأیید شد.*\n\n"
+            f"• *پزشک:* {_md_escape(appt.doctor.name)}\n"
+            f"• *تخصص:* {_md_escape(appt.appointment_type)}\n"
+            f"• *روش ارتباط:* {_md_escape(appt.contact_method)}\n\n"
+            f"از انتخاب *Doctor Line* متشکریم!"
+        ),
+        f"✅ *ملاقات {appt_id} تأیید شد.*\n*کاربر:* {_md_escape(appt.user.name)}\n*پزشک:* {_md_escape(appt.doctor.name)}",
+    )
 
-async def approve_certificate(update: Update, context: ContextTypes.DEFAULT_TYPE, cert_id: int):
-    query = update.callback_query
-    logger.debug(f"توسعه‌دهنده در حال تأیید گواهی سلامت شناسه: {cert_id}")
 
-    with Session() as session:
-        cert = session.query(HealthCertificate).filter_by(id=cert_id).first()
-        if cert and cert.status == 'pending':
-            cert.status = 'approved'
-            try:
-                session.commit()
-                logger.info(f"گواهی سلامت {cert_id} تأیید شد.")
-            except IntegrityError as e:
-                logger.error(f"خطا در تأیید گواهی سلامت {cert_id}: {e}")
-                session.rollback()
-                await query.edit_message_text("*❌ تأیید گواهی سلامت ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                              parse_mode="Markdown")
-                return
-            user = cert.user
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=(
-                        f"✅ *درخواست گواهی سلامت شما (شناسه: {cert_id}) تأیید شد.*\n\n"
-                        f"از انتخاب *Doctor Line* متشکریم!"
-                    ),
-                    parse_mode="Markdown"
-                )
-                logger.info(f"کاربر {user.telegram_id} در مورد تأیید گواهی سلامت مطلع شد.")
-            except Exception as e:
-                logger.error(f"خطا در اطلاع‌رسانی به کاربر {user.telegram_id} در مورد تأیید گواهی سلامت: {e}")
-
-            # Send approval email to user
-            email_subject = "✅ گواهی سلامت تأیید شد"
-            email_body = (
-                f"سلام {user.name},\n\n"
-                f"تبریک! درخواست گواهی سلامت شما (شناسه: {cert_id}) تأیید شد.\n\n"
-                f"• *دلیل:* {cert.reason}\n"
-                f"• *توضیح:* {cert.description}\n\n"
-                f"شما اکنون می‌توانید با هرگونه نیازمندی لازم ادامه دهید.\n\n"
-                f"از انتخاب *Doctor Line* متشکریم.\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-            send_email(user.email, email_subject, email_body)
+def _appt_rejected_texts(appt_id, appt):
+    """User notice and developer ack for a rejected appointment."""
+    return (
+        f"❌ *ملاقات شما (شناسه: {appt_id}) رد شد.*",
+        f"❌ *ملاقات {appt_id} رد شد.*\n*کاربر:* {_md_escape(appt.user.name)}",
+    )
+
+
+def _cert_approved_texts(cert_id, cert):
+    """User notice and developer ack for an approved certificate."""
+    return (
+        (
+            f"✅ *درخواست گواهی سلامت شما (شناسه: {cert_id}) تأیید شد.*\n\n"
+            f"از انتخاب *Doctor Line* متشکریم!"
+        ),
+        f"✅ *گواهی سلامت {cert_id} تأیید شد.*\n*کاربر:* {_md_escape(cert.user.name)}",
+    )
+
+
+def _cert_rejected_texts(cert_id, cert):
+    """User notice and developer ack for a rejected certificate."""
+    return (
+        f"❌ *درخواست گواهی سلامت شما (شناسه: {cert_id}) رد شد.*",
+        f"❌ *گواهی سلامت {cert_id} رد شد.*\n*کاربر:* {_md_escape(cert.user.name)}",
+    )
+
+
+def _appt_approved_email_ctx(appt_id, appt):
+    return {
+        'name': appt.user.name,
+        'appt_id': appt_id,
+        'doctor_name': appt.doctor.name,
+        'appointment_type': appt.appointment_type,
+        'contact_method': appt.contact_method,
+        'created_at': f"{appt.created_at:%Y-%m-%d %H:%M}",
+    }
+
+
+def _appt_rejected_email_ctx(appt_id, appt):
+    return {
+        'name': appt.user.name,
+        'appt_id': appt_id,
+        'doctor_name': appt.doctor.name,
+    }
+
+
+def _cert_approved_email_ctx(cert_id, cert):
+    return {
+        'name': cert.user.name,
+        'cert_id': cert_id,
+        'reason': cert.reason,
+        'description': cert.description,
+    }
 
-            await query.edit_message_text(
-                text=f"✅ *گواهی سلامت {cert_id} تأیید شد.*\n*کاربر:* {user.name}",
-                parse_mode="Markdown"
-            )
-        else:
-            logger.warning(f"گواهی سلامت {cert_id} نامعتبر یا قبلاً پردازش شده است.")
-            await query.edit_message_text("*❌ شناسه گواهی سلامت نامعتبر یا قبلاً پردازش شده است.*",
-                                          parse_mode="Markdown")
 
+def _cert_rejected_email_ctx(cert_id, cert):
+    return {
+        'name': cert.user.name,
+        'cert_id': cert_id,
+    }
+
+
+# Everything that distinguishes one approve/reject action from another, so a
+# single coroutine can serve all four. `verb` and `label` slot into the shared
+# log/error strings; `texts` and `email_ctx` take (entity_id, entity) and
+# build the Telegram texts and the email template context.
+TransitionSpec = namedtuple(
+    "TransitionSpec",
+    ["model", "load_options", "new_status", "label", "verb",
+     "email_subject", "email_tmpl", "email_ctx", "texts", "user_parse_mode"],
+)
+
+APPT_APPROVE = TransitionSpec(
+    model=Appointment,
+    load_options=(joinedload(Appointment.user), joinedload(Appointment.doctor)),
+    new_status='confirmed',
+    label="ملاقات",
+    verb="تأیید",
+    email_subject="✅ ملاقات تأیید شد",
+    email_tmpl=APPT_APPROVED_EMAIL_TMPL,
+    email_ctx=_appt_approved_email_ctx,
+    texts=_appt_approved_texts,
+    user_parse_mode="Markdown",
+)
+
+APPT_REJECT = TransitionSpec(
+    model=Appointment,
+    load_options=(joinedload(Appointment.user), joinedload(Appointment.doctor)),
+    new_status='rejected',
+    label="ملاقات",
+    verb="رد",
+    email_subject="❌ ملاقات رد شد",
+    email_tmpl=APPT_REJECTED_EMAIL_TMPL,
+    email_ctx=_appt_rejected_email_ctx,
+    texts=_appt_rejected_texts,
+    user_parse_mode=None,
+)
 
-async def reject_certificate(update: Update, context: ContextTypes.DEFAULT_TYPE, cert_id: int):
+CERT_APPROVE = TransitionSpec(
+    model=HealthCertificate,
+    load_options=(joinedload(HealthCertificate.user),),
+    new_status='approved',
+    label="گواهی سلامت",
+    verb="تأیید",
+    email_subject="✅ گواهی سلامت تأیید شد",
+    email_tmpl=CERT_APPROVED_EMAIL_TMPL,
+    email_ctx=_cert_approved_email_ctx,
+    texts=_cert_approved_texts,
+    user_parse_mode="Markdown",
+)
+
+CERT_REJECT = TransitionSpec(
+    model=HealthCertificate,
+    load_options=(joinedload(HealthCertificate.user),),
+    new_status='rejected',
+    label="گواهی سلامت",
+    verb="رد",
+    email_subject="❌ گواهی سلامت رد شد",
+    email_tmpl=CERT_REJECTED_EMAIL_TMPL,
+    email_ctx=_cert_rejected_email_ctx,
+    texts=_cert_rejected_texts,
+    user_parse_mode=None,
+)
+
+
+async def handle_transition(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            entity_id: int, spec: TransitionSpec):
+    """Shared body of the four approve/reject actions.
+
+    The handlers were structural copies differing only in model, target
+    status, and message templates; keeping one copy means the atomic
+    UPDATE, eager loading, email queueing, and gathered sends live in
+    exactly one place.
+    """
     query = update.callback_query
-    logger.debug(f"توسعه‌دهنده در حال رد گواهی سلامت شناسه: {cert_id}")
+    logger.debug(f"توسعه‌دهنده در حال {spec.verb} {spec.label} شناسه: {entity_id}")
 
+    # All DB work happens here and the session closes before any await, so
+    # the pooled connection isn't held across Telegram round-trips.
     with Session() as session:
-        cert = session.query(HealthCertificate).filter_by(id=cert_id).first()
-        if cert and cert.status == 'pending':
-            cert.status = 'rejected'
-            try:
-                session.commit()
-                logger.info(f"گواهی سلامت {cert_id} رد شد.")
-            except IntegrityError as e:
-                logger.error(f"خطا در رد گواهی سلامت {cert_id}: {e}")
-                session.rollback()
-                await query.edit_message_text("*❌ رد گواهی سلامت ناموفق بود. لطفاً دوباره تلاش کنید.*",
-                                              parse_mode="Markdown")
-                return
-            user = cert.user
-            try:
-                await context.bot.send_message(
-                    chat_id=user.telegram_id,
-                    text=f"❌ *درخواست گواهی سلامت شما (شناسه: {cert_id}) رد شد.*"
-                )
-                logger.info(f"کاربر {user.telegram_id} در مورد رد گواهی سلامت مطلع شد.")
-            except Exception as e:
-                logger.error(f"خطا در اطلاع‌رسانی به کاربر {user.telegram_id} در مورد رد گواهی سلامت: {e}")
-
-            # Send rejection email to user
-            email_subject = "❌ گواهی سلامت رد شد"
-            email_body = (
-                f"سلام {user.name},\n\n"
-                f"با تاسف اعلام می‌کنیم که درخواست گواهی سلامت شما (شناسه: {cert_id}) "
-                f"رد شده است.\n\n"
-                f"اگر فکر می‌کنید این اشتباه است یا می‌خواهید دوباره درخواست دهید، لطفاً با ما تماس بگیرید.\n\n"
-                f"از درک شما متشکریم.\n\n"
-                f"با احترام,\n*تیم Doctor Line*"
-            )
-            send_email(user.email, email_subject, email_body)
+        # Atomic compare-and-set: two developers double-tapping race on the
+        # same row, and only the one whose UPDATE matches status='pending'
+        # proceeds to notify.
+        try:
+            updated = session.execute(
+                sql_update(spec.model)
+                .where(spec.model.id == entity_id, spec.model.status == 'pending')
+                .values(status=spec.new_status)
+            ).rowcount
+            session.commit()
+        except IntegrityError as e:
+            logger.error(f"خطا در {spec.verb} {spec.label} {entity_id}: {e}")
+            session.rollback()
+            updated = None
+        if updated:
+            invalidate_statistics()
+            logger.info(f"{spec.label} {entity_id} {spec.verb} شد.")
+            entity = session.get(spec.model, entity_id,
+                                 options=list(spec.load_options))
+            user_chat_id, user_email = entity.user.telegram_id, entity.user.email
+            email_body = spec.email_tmpl.format_map(spec.email_ctx(entity_id, entity))
+            user_text, ack_text = spec.texts(entity_id, entity)
+
+    if updated is None:
+        await query.edit_message_text(
+            f"*❌ {spec.verb} {spec.label} ناموفق بود. لطفاً دوباره تلاش کنید.*",
+            parse_mode="Markdown")
+        return
+    if not updated:
+        logger.warning(f"{spec.label} {entity_id} نامعتبر یا قبلاً پردازش شده است.")
+        await query.edit_message_text(
+            f"*❌ شناسه {spec.label} نامعتبر یا قبلاً پردازش شده است.*",
+            parse_mode="Markdown")
+        return
+
+    queue_email(user_email, spec.email_subject, email_body)
+    # User notification and developer acknowledgement are independent;
+    # issue them concurrently.
+    await _gather_sends(
+        f"اطلاع‌رسانی {spec.verb} {spec.label} {entity_id}",
+        _rl_send(context.bot.send_message, chat_id=user_chat_id,
+                 text=user_text, parse_mode=spec.user_parse_mode),
+        query.edit_message_text(text=ack_text, parse_mode="Markdown"),
+    )
 
-            await query.edit_message_text(
-                text=f"❌ *گواهی سلامت {cert_id} رد شد.*\n*کاربر:* {user.name}",
-                parse_mode="Markdown"
-            )
-        else:
-            logger.warning(f"گواهی سلامت {cert_id} نامعتبر یا قبلاً پردازش شده است.")
-            await query.edit_message_text("*❌ شناسه گواهی سلامت نامعتبر یا قبلاً پردازش شده است.*",
-                                          parse_mode="Markdown")
+
+DEV_ACTION_DISPATCH = {
+    "confirm_appt": APPT_APPROVE,
+    "reject_appt": APPT_REJECT,
+    "approve_cert": CERT_APPROVE,
+    "reject_cert": CERT_REJECT,
+}
 
 
 ##################
 # Profile Editing Handlers
 ##################
 
+# menu label -> (prompt, next conversation state)
+EDIT_MENU_DISPATCH = {
+    "ویرایش نام": ("*📝 نام جدید خود را وارد کنید:*", EDIT_NAME),
+    "ویرایش تلفن/شناسه": ("*📱 شماره تلفن یا شناسه جدید خود را وارد کنید:*", EDIT_PHONE),
+    "ویرایش ایمیل": ("*📧 آدرس ایمیل جدید خود را وارد کنید:*", EDIT_EMAIL),
+}
+
+
 async def edit_profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     choice = update.message.text.strip()
-    user_id = update.effective_user.id
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
 
-    if choice == "ویرایش نام":
-        await update.message.reply_text("*📝 نام جدید خود را وارد کنید:*",
-                                        parse_mode="Markdown",
-                                        reply_markup=back_cancel_menu_keyboard())
-        return EDIT_NAME
-    elif choice == "ویرایش تلفن/شناسه":
-        await update.message.reply_text("*📱 شماره تلفن یا شناسه جدید خود را وارد کنید:*",
+    entry = EDIT_MENU_DISPATCH.get(choice)
+    if entry is not None:
+        prompt, state = entry
+        await update.message.reply_text(prompt,
                                         parse_mode="Markdown",
                                         reply_markup=back_cancel_menu_keyboard())
-        return EDIT_PHONE
-    elif choice == "ویرایش ایمیل":
-        await update.message.reply_text("*📧 آدرس ایمیل جدید خود را وارد کنید:*",
-                                        parse_mode="Markdown",
-                                        reply_markup=back_cancel_menu_keyboard())
-        return EDIT_EMAIL
-    elif choice == "🔙 بازگشت":
+        return state
+
+    if choice == "🔙 بازگشت":
         await update.message.reply_text("*🔙 بازگشت به منوی اصلی.*", parse_mode="Markdown",
-                                        reply_markup=main_menu_keyboard(user_id))
+                                        reply_markup=main_menu_keyboard(update.effective_user.id))
         return MAIN_MENU
-    elif choice == "❌ لغو":
+    if choice == "❌ لغو":
         return await cancel(update, context)
-    else:
-        await update.message.reply_text("*❌ انتخاب نامعتبر است.* لطفاً یک گزینه از منوی ویرایش پروفایل را انتخاب کنید.",
-                                        parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
-        return EDIT_PROFILE_MENU
+
+    await update.message.reply_text("*❌ انتخاب نامعتبر است.* لطفاً یک گزینه از منوی ویرایش پروفایل را انتخاب کنید.",
+                                    parse_mode="Markdown",
+                                    reply_markup=_EDIT_PROFILE_MENU_ONCE_KB)
+    return EDIT_PROFILE_MENU
 
 
 async def edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -2267,11 +2811,7 @@ async def edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if new_name == "🔙 بازگشت":
         await update.message.reply_text("*🔙 بازگشت به منوی ویرایش پروفایل.*", parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=_EDIT_PROFILE_MENU_ONCE_KB)
         return EDIT_PROFILE_MENU
 
     if new_name == "❌ لغو":
@@ -2284,11 +2824,12 @@ async def edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return EDIT_NAME
 
     with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+        user = session.execute(_USER_BY_TG, {'tid': user_id}).scalar_one_or_none()
         if user:
             user.name = new_name
             try:
                 session.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"کاربر {user_id} نام خود را به '{new_name}' به‌روزرسانی کرد.")
                 await update.message.reply_text("*✅ نام با موفقیت به‌روزرسانی شد.*",
                                                 parse_mode="Markdown",
@@ -2312,11 +2853,7 @@ async def edit_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if new_phone == "🔙 بازگشت":
         await update.message.reply_text("*🔙 بازگشت به منوی ویرایش پروفایل.*", parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=_EDIT_PROFILE_MENU_ONCE_KB)
         return EDIT_PROFILE_MENU
 
     if new_phone == "❌ لغو":
@@ -2329,11 +2866,12 @@ async def edit_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return EDIT_PHONE
 
     with Session() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+        user = session.execute(_USER_BY_TG, {'tid': user_id}).scalar_one_or_none()
         if user:
             user.phone = new_phone
             try:
                 session.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"کاربر {user_id} شماره تلفن/شناسه خود را به '{new_phone}' به‌روزرسانی کرد.")
                 await update.message.reply_text("*✅ شماره تلفن/شناسه با موفقیت به‌روزرسانی شد.*",
                                                 parse_mode="Markdown",
@@ -2357,11 +2895,7 @@ async def edit_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if new_email == "🔙 بازگشت":
         await update.message.reply_text("*🔙 بازگشت به منوی ویرایش پروفایل.*", parse_mode="Markdown",
-                                        reply_markup=ReplyKeyboardMarkup(
-                                            [["ویرایش نام"], ["ویرایش تلفن/شناسه"], ["ویرایش ایمیل"], ["🔙 بازگشت"]],
-                                            resize_keyboard=True,
-                                            one_time_keyboard=True
-                                        ))
+                                        reply_markup=_EDIT_PROFILE_MENU_ONCE_KB)
         return EDIT_PROFILE_MENU
 
     if new_email == "❌ لغو":
@@ -2375,17 +2909,19 @@ async def edit_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return EDIT_EMAIL
 
     with Session() as session:
-        existing_user = session.query(User).filter(User.email == new_email, User.telegram_id != user_id).first()
-        if existing_user:
+        email_taken = session.query(User.id).filter(
+            User.email == new_email, User.telegram_id != user_id).scalar() is not None
+        if email_taken:
             await update.message.reply_text("*❌ این ایمیل قبلاً استفاده شده است.* لطفاً یک ایمیل متفاوت وارد کنید:",
                                             parse_mode="Markdown",
                                             reply_markup=back_cancel_menu_keyboard())
             return EDIT_EMAIL
-        user = session.query(User).filter_by(telegram_id=user_id).first()
+        user = session.execute(_USER_BY_TG, {'tid': user_id}).scalar_one_or_none()
         if user:
             user.email = new_email
             try:
                 session.commit()
+                invalidate_user_cache(user_id)
                 logger.info(f"کاربر {user_id} ایمیل خود را به '{new_email}' به‌روزرسانی کرد.")
                 await update.message.reply_text("*✅ ایمیل با موفقیت به‌روزرسانی شد.*",
                                                 parse_mode="Markdown",
@@ -2431,7 +2967,14 @@ conv_handler = ConversationHandler(
         EDIT_EMAIL: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_email)],
 
         DEVELOPER_MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, developer_menu_handler)],
-        DEV_MANAGE_SPECIALIZATIONS: [MessageHandler(filters.TEXT & ~filters.COMMAND, dev_manage_specializations)],
+        # Exact-match routing happens in PTB's dispatcher; the plain-text
+        # fallback replies "invalid choice" (and handles cancel).
+        DEV_MANAGE_SPECIALIZATIONS: [
+            MessageHandler(filters.Regex(r"^➕ افزودن تخصص$"), _manage_specs_add),
+            MessageHandler(filters.Regex(r"^➖ حذف تخصص$"), _manage_specs_remove),
+            MessageHandler(filters.Regex(r"^🔙 بازگشت$"), _manage_specs_back),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, dev_manage_specializations),
+        ],
         DEV_ADD_SPECIALIZATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, dev_add_specialization)],
         DEV_REMOVE_SPECIALIZATION_SELECT: [
             MessageHandler(filters.TEXT & ~filters.COMMAND, dev_remove_specialization_select)],
@@ -2470,13 +3013,58 @@ conv_handler = ConversationHandler(
 # Application Setup
 ##################
 
-application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+# Cross-chat concurrency with per-chat ordering: concurrent_updates lets
+# different chats proceed in parallel, while a per-chat lock keeps updates
+# from one chat strictly sequential. The lock must cover the whole
+# process_update call, not just the handler callback: ConversationHandler
+# resolves the conversation state in check_update before any callback runs,
+# so two same-chat updates from one getUpdates batch would otherwise both
+# route on the pre-transition state.
+class _ChatLock:
+    __slots__ = ("lock", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.refs = 0
+
+
+_CHAT_LOCKS: dict = {}
+
+
+class PerChatApplication(Application):
+    """Application that serializes update processing per chat."""
+
+    async def process_update(self, update):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            return await super().process_update(update)
+        entry = _CHAT_LOCKS.setdefault(chat.id, _ChatLock())
+        # Refcount holders plus waiters ourselves; when it hits zero the
+        # entry is dropped so the table doesn't grow with every chat seen.
+        entry.refs += 1
+        try:
+            async with entry.lock:
+                return await super().process_update(update)
+        finally:
+            entry.refs -= 1
+            if entry.refs == 0:
+                _CHAT_LOCKS.pop(chat.id, None)
+
+
+# A larger connection pool lets concurrent handler sends reuse persistent
+# connections to api.telegram.org instead of queueing on PTB's default
+# pool. get_updates keeps its own dedicated request object.
+_bot_request = HTTPXRequest(connection_pool_size=64, pool_timeout=5.0)
+application = ApplicationBuilder().token(TELEGRAM_TOKEN).request(_bot_request) \
+    .application_class(PerChatApplication) \
+    .post_init(_start_background_tasks).post_shutdown(_graceful_shutdown) \
+    .concurrent_updates(True).build()
+_developer_action_cb = CallbackQueryHandler(
+    developer_action_handler,
+    pattern=re.compile(r"^(confirm_appt_|reject_appt_|approve_cert_|reject_cert_)\d+$"))
 application.add_handler(conv_handler)
-application.add_handler(
-    CallbackQueryHandler(developer_action_handler,
-                         pattern=r"^(confirm_appt_|reject_appt_|approve_cert_|reject_cert_)\d+$")
-)
-application.add_handler(CommandHandler('sendmsg', send_message_to_user, filters=filters.User(DEVELOPER_CHAT_ID)))
+application.add_handler(_developer_action_cb)
+application.add_handler(CommandHandler('sendmsg', send_message_to_user, filters=filters.User(ADMIN_IDS)))
 
 
 ##################
@@ -2491,9 +3079,14 @@ async def get_developer_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                     parse_mode="Markdown")
 
 
+def _read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 # Temporary command to send test receipt to developer
 async def send_test_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != DEVELOPER_CHAT_ID:
+    if update.effective_user.id not in ADMIN_IDS:
         await update.message.reply_text("*❌ شما مجاز به استفاده از این دستور نیستید.*",
                                         parse_mode="Markdown")
         return
@@ -2504,13 +3097,15 @@ async def send_test_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "*❌ فایل رسید تست پیدا نشد.* لطفاً اطمینان حاصل کنید که 'test_receipt.jpg' در دایرکتوری ربات موجود است.",
                 parse_mode="Markdown")
             return
-        with open(test_photo_path, 'rb') as photo_file:
-            await context.bot.send_photo(
-                chat_id=DEVELOPER_CHAT_ID,
-                photo=photo_file,
-                caption="📷 *رسید تست*",
-                parse_mode="Markdown"
-            )
+        # Read off the event loop so a cold-cache disk read doesn't stall
+        # other pending updates.
+        photo_bytes = await asyncio.to_thread(_read_file_bytes, test_photo_path)
+        await context.bot.send_photo(
+            chat_id=DEVELOPER_CHAT_ID,
+            photo=photo_bytes,
+            caption="📷 *رسید تست*",
+            parse_mode="Markdown"
+        )
         await update.message.reply_text("*✅ رسید تست به توسعه‌دهنده ارسال شد.*",
                                         parse_mode="Markdown")
     except Exception as e:
@@ -2520,41 +3115,22 @@ async def send_test_receipt(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # Add temporary handlers (Remove these after verification)
-application.add_handler(CommandHandler('getdevid', get_developer_id, filters=filters.User(DEVELOPER_CHAT_ID)))
-application.add_handler(CommandHandler('sendtestreceipt', send_test_receipt, filters=filters.User(DEVELOPER_CHAT_ID)))
-
-
-##################
-# Scheduler (Optional)
-##################
-
-scheduler.start()
-logger.info("زمان‌بندی شروع شد.")
+application.add_handler(CommandHandler('getdevid', get_developer_id, filters=filters.User(ADMIN_IDS)))
+application.add_handler(CommandHandler('sendtestreceipt', send_test_receipt, filters=filters.User(ADMIN_IDS)))
 
 
-##################
-# Shutdown Handler
-##################
-
-def shutdown_handler(signum, frame):
-    logger.info("در حال خاموش‌سازی...")
-    scheduler.shutdown()
-    sys.exit(0)
-
-signal.signal(signal.SIGINT, shutdown_handler)
-signal.signal(signal.SIGTERM, shutdown_handler)
-
 ##################
 # Main Execution
 ##################
 
+# Shutdown is cooperative: run_polling() installs its own SIGINT/SIGTERM
+# handlers and stops the loop between updates, then post_shutdown runs
+# _graceful_shutdown. A raw signal handler calling sys.exit() would tear
+# the loop down mid-request instead.
+
 if __name__ == '__main__':
     # Make sure tables exist before starting the bot
     init_db()  # <-- Call init_db() here
 
     logger.info("شروع ربات...")
-    try:
-        application.run_polling()
-    except KeyboardInterrupt:
-        logger.info("ربات توسط KeyboardInterrupt متوقف شد.")
-        scheduler.shutdown()
+    application.run_polling()
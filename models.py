@@ -1,7 +1,11 @@
 # models.py
 
-from datetime import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Text, create_engine
+import os
+from datetime import datetime, timezone
+from sqlalchemy import (
+    Column, Integer, String, ForeignKey, Boolean, DateTime, Text,
+    Index, UniqueConstraint, create_engine, event,
+)
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -10,8 +14,46 @@ Base = declarative_base()
 # Replace with your actual database URL
 DATABASE_URL = "sqlite:///bot_database.db"  # For SQLite (development or testing)
 
-engine = create_engine(DATABASE_URL, echo=False)
-Session = sessionmaker(bind=engine)
+# Explicit pool sizing: every handler opens a short-lived Session, so under
+# concurrent load the default 5+10 pool becomes the bottleneck. pre_ping
+# transparently replaces connections dropped during idle periods.
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=20,
+    max_overflow=40,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_timeout=30,
+)
+
+# SQLite defaults to a rollback journal with synchronous=FULL: every commit
+# fsyncs and writers block readers. WAL lets the read-heavy menu traffic
+# proceed during writes, and synchronous=NORMAL is durable enough in WAL
+# mode (a crash can lose the last commit but never corrupts the file).
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _connection_record):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+# expire_on_commit=False keeps attributes loaded after commit, so reading a
+# freshly assigned PK (certificate.id, appointment.id) doesn't re-SELECT the
+# row. All sessions are short-lived per handler, so staleness isn't a concern.
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+# Opt-in strict loading: with SQLA_STRICT_LOADS set, relationships that are
+# expected to be eager-loaded raise on lazy access instead of silently
+# issuing N+1 queries. Meant for test/CI runs, not production.
+_STRICT_LAZY = "raise" if os.getenv("SQLA_STRICT_LOADS") else "select"
+
+
+def utcnow():
+    """Timezone-aware replacement for the deprecated datetime.utcnow()."""
+    return datetime.now(timezone.utc)
 
 
 class User(Base):
@@ -38,6 +80,11 @@ class Specialization(Base):
 
 class Doctor(Base):
     __tablename__ = 'doctors'
+    # One doctor name per specialization; also backs the duplicate check in
+    # the add-doctor flow with an index lookup instead of a scan.
+    __table_args__ = (
+        UniqueConstraint('name', 'specialization_id', name='uq_doctor_name_spec'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
@@ -51,6 +98,12 @@ class Doctor(Base):
 
 class Appointment(Base):
     __tablename__ = 'appointments'
+    # Status counters and the per-doctor cancel/remove flows filter on these
+    # columns; B-tree indexes keep them off full table scans.
+    __table_args__ = (
+        Index('ix_appt_status', 'status'),
+        Index('ix_appt_doctor_status', 'doctor_id', 'status'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -59,21 +112,24 @@ class Appointment(Base):
     contact_method = Column(String(50), nullable=False)
     description = Column(Text, nullable=False)
     status = Column(String(20), default='pending')  # pending, confirmed, rejected, canceled
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=utcnow)
 
     user = relationship("User", back_populates="appointments")
-    doctor = relationship("Doctor", back_populates="appointments")
+    doctor = relationship("Doctor", back_populates="appointments", lazy=_STRICT_LAZY)
 
 
 class HealthCertificate(Base):
     __tablename__ = 'health_certificates'
+    __table_args__ = (
+        Index('ix_cert_status', 'status'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     reason = Column(String(100), nullable=False)
     description = Column(Text, nullable=False)
     status = Column(String(20), default='pending')  # pending, approved, rejected
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, default=utcnow)
 
     user = relationship("User", back_populates="certificates")
 